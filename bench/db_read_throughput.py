@@ -0,0 +1,94 @@
+"""
+measure database read throughput while a writer commits concurrently.
+
+compares the default rollback journal (reads share the writer connection)
+with wal mode (reads use a pool of read-only connections)
+and the in-memory backend (no disk io at all).
+
+usage: python -m bench.db_read_throughput [--seconds 5] [--readers 8]
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from cyberbot.database import Database
+from cyberbot.db_backend import MemoryBackend, StorageBackend
+
+
+async def _fill(db: Database, rooms: int, keys: int) -> None:
+    await db.write_many(
+        "insert into room_plugin_data(roomid, pluginname, key, value) values (?, ?, ?, ?);",
+        ((f"!room{room}:bench", "bench", f"key{key}", "x" * 100)
+         for room in range(rooms) for key in range(keys)),
+    )
+
+
+async def _writer(db: Database, stop: asyncio.Event) -> int:
+    commits = 0
+    while not stop.is_set():
+        await db.write(
+            "insert or replace into room_plugin_data(roomid, pluginname, key, value) values (?, ?, ?, ?);",
+            ("!writer:bench", "bench", f"key{commits % 100}", str(commits)),
+        )
+        commits += 1
+    return commits
+
+
+async def _reader(db: Database, stop: asyncio.Event, idx: int, rooms: int, keys: int) -> int:
+    reads = 0
+    while not stop.is_set():
+        await db.read_one(
+            "select value from room_plugin_data where roomid=? and pluginname=? and key=?;",
+            (f"!room{(idx + reads) % rooms}:bench", "bench", f"key{reads % keys}"),
+        )
+        reads += 1
+    return reads
+
+
+async def bench(name: str, db: Database, *, seconds: float, readers: int, rooms: int, keys: int) -> None:
+    try:
+        await db.migrate()
+        await _fill(db, rooms, keys)
+
+        stop = asyncio.Event()
+        writer = asyncio.create_task(_writer(db, stop))
+        reader_tasks = [asyncio.create_task(_reader(db, stop, idx, rooms, keys)) for idx in range(readers)]
+
+        start = time.monotonic()
+        await asyncio.sleep(seconds)
+        stop.set()
+        commits = await writer
+        reads = sum(await asyncio.gather(*reader_tasks))
+        duration = time.monotonic() - start
+
+        print(f"{name:>16}: "
+              f"{reads / duration:10.1f} reads/s, {commits / duration:8.1f} commits/s")
+    finally:
+        await db.close()
+
+
+def main() -> None:
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--seconds", type=float, default=5)
+    cli.add_argument("--readers", type=int, default=8)
+    cli.add_argument("--rooms", type=int, default=1000)
+    cli.add_argument("--keys", type=int, default=10)
+    args = cli.parse_args()
+
+    bench_args = dict(seconds=args.seconds, readers=args.readers, rooms=args.rooms, keys=args.keys)
+
+    async def run(name: str, backend: StorageBackend | Path, wal: bool = False) -> None:
+        await bench(name, Database(backend, wal=wal, read_connections=args.readers), **bench_args)
+
+    for wal in (False, True):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            asyncio.run(run("wal" if wal else "rollback journal", Path(tmpdir) / "bench.db", wal))
+
+    asyncio.run(run("memory", MemoryBackend()))
+
+
+if __name__ == "__main__":
+    main()
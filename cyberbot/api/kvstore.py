@@ -1,134 +1,773 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+import asyncio
+import enum
+import json
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import cache
+from typing import TYPE_CHECKING, Any, overload
+
+import pydantic_core
+from pydantic import TypeAdapter
 
 if TYPE_CHECKING:
-    from .database import Database
+    from contextlib import AbstractAsyncContextManager
+    from typing import AsyncIterator, Collection, Iterable, Iterator, Mapping
 
+    from ..database import Database, Row, Transaction
 
-class KVStore:
+logger = logging.getLogger(__name__)
+
+
+class _Scope(enum.Enum):
     """
-    a persistent key-value store.
+    storage realm of a key, each has its own table.
+    """
+    room = enum.auto()
+    plugin = enum.auto()
+    room_plugin = enum.auto()
 
-    supports the following realms:
-    - for a plugin and a room  (try to use this)
-    - for a plugin             (for sharing across rooms)
-    - for a room               (for sharing across plugins)
+
+@dataclass(frozen=True)
+class _Statements:
+    """
+    sql statements for one scope.
+    the scope's id columns are the first parameters of each statement.
+    reads skip expired entries, the current time is the parameter after the ids.
     """
+    table: str
+    keys: str
+    get: str
+    # keys are passed as json array
+    get_many: str
+    set: str
+    rm: str
+    # keys in [start, end) and from start
+    rm_range: str
+    rm_from: str
+    # pages of keys or (key, value) in [start, end) and from start, ordered by key
+    scan_keys_range: str
+    scan_keys_from: str
+    scan_items_range: str
+    scan_items_from: str
+    # usage of the scope, count and size of the given entries, for quota checks
+    usage: str
+    # delete a batch of expired entries of all scopes: (now, limit)
+    expire: str
+    # delete the expired entries of the scope
+    expire_scope: str
+
+    @classmethod
+    def build(cls, table: str, id_columns: tuple[str, ...]) -> _Statements:
+        where = " and ".join(f"{column}=?" for column in id_columns)
+        columns = ", ".join(id_columns)
+        placeholders = ", ".join("?" for _ in id_columns)
+        live = f"{where} and (expires is null or expires > ?)"
+        key_list = "key in (select value from json_each(?))"
+        return cls(
+            table=table,
+            keys=f"select key from {table} where {live};",
+            get=f"select value, expires from {table} where {live} and key=?;",
+            get_many=f"select key, value, expires from {table} where {live} and {key_list};",
+            set=(f"insert or replace into {table}({columns}, key, value, expires) "
+                 f"values ({placeholders}, ?, ?, ?);"),
+            rm=f"delete from {table} where {where} and key=?;",
+            rm_range=f"delete from {table} where {where} and key >= ? and key < ?;",
+            rm_from=f"delete from {table} where {where} and key >= ?;",
+            scan_keys_range=f"select key from {table} where {live} and key >= ? and key < ? order by key limit ?;",
+            scan_keys_from=f"select key from {table} where {live} and key >= ? order by key limit ?;",
+            scan_items_range=(f"select key, value from {table} where {live} and key >= ? and key < ? "
+                              f"order by key limit ?;"),
+            scan_items_from=f"select key, value from {table} where {live} and key >= ? order by key limit ?;",
+            usage=(f"select coalesce(usage.keys, 0), coalesce(usage.bytes, 0), old.keys, old.bytes from "
+                   f"(select count(*) as keys, "
+                   f"coalesce(sum(length(cast(key as blob)) + coalesce(length(cast(value as blob)), 0)), 0) "
+                   f"as bytes from {table} where {where} and {key_list}) as old "
+                   f"left join storage_usage as usage on usage.roomid=? and usage.pluginname=?;"),
+            expire=(f"delete from {table} where rowid in "
+                    f"(select rowid from {table} where expires <= ? limit ?);"),
+            expire_scope=f"delete from {table} where {where} and expires <= ?;",
+        )
 
-    def __init__(self, db: Database, plugin_name: str, room_id: str):
-        self._db = db
-        self._plugin_name = plugin_name
-        self._room_id = room_id
 
-    async def keys(self, room: bool = True, plugin: bool = True):
-        if not (room or plugin):
-            raise RuntimeError('either per-room or per-plugin scope must be set')
+def _expiry(ttl: float | None) -> float | None:
+    if ttl is None:
+        return None
+    if ttl <= 0:
+        raise ValueError("ttl must be positive")
+    return time.time() + ttl
 
-        qwhere = list()
-        args = list()
 
-        if room:
-            table = "room_data"
-            qwhere.append('roomid=?')
-            args.append(self._room_id)
+# all live room x plugin entries of one room, or of all rooms
+_PRELOAD_ROOM = ("select roomid, key, value, expires from room_plugin_data "
+                 "where roomid=? and pluginname=? and (expires is null or expires > ?);")
+_PRELOAD_ROOMS = ("select roomid, key, value, expires from room_plugin_data "
+                  "where pluginname=? and (expires is null or expires > ?);")
 
-        if plugin:
-            table = "plugin_data"
-            qwhere.append('pluginname=?')
-            args.append(self._plugin_name)
 
-        if room and plugin:
-            table = "room_plugin_data"
+async def preload(db: Database, cache: KVCache, plugin_name: str, room_ids: Collection[str]) -> int:
+    """
+    load all room x plugin entries of the plugin in the given rooms into the cache.
+    one room is fetched with an index lookup, more rooms with a single scan of all the plugin's entries.
+    returns the number of loaded entries.
+    """
+    room_ids = [room_id for room_id in room_ids
+                if not cache.is_complete(("room_plugin_data", room_id, plugin_name))]
+    if not room_ids:
+        return 0
+
+    generation = cache.generation
+    if len(room_ids) == 1:
+        rows = await db.read(_PRELOAD_ROOM, (room_ids[0], plugin_name, time.time()))
+    else:
+        rows = await db.read(_PRELOAD_ROOMS, (plugin_name, time.time()))
+
+    wanted = set(room_ids)
+    rows = [row for row in rows if row[0] in wanted]
+    if len(rows) > cache.size:
+        # the entries would evict each other
+        logger.info("not preloading %d storage entries of plugin %s, the cache only holds %d",
+                    len(rows), plugin_name, cache.size)
+        return 0
+
+    room_keys: dict[str, list[CacheKey]] = {room_id: [] for room_id in room_ids}
+    for room_id, key, value, expires in rows:
+        cache_key = ("room_plugin_data", room_id, plugin_name, key)
+        cache.store(cache_key, value, generation, expires)
+        room_keys[room_id].append(cache_key)
+    for room_id, keys in room_keys.items():
+        cache.mark_complete(("room_plugin_data", room_id, plugin_name), generation, keys)
+    return len(rows)
+
+
+async def delete_expired(db: Database, limit: int) -> int:
+    """
+    delete up to limit expired entries of each table, returns the number of deleted entries.
+    """
+    now = time.time()
+    deleted = 0
+    for statements in _STATEMENTS.values():
+        deleted += await db.write(statements.expire, (now, limit))
+    return deleted
 
-        ret = self._db.read(
-            f"select key from {table} where {' and '.join(qwhere)};",
-            args,
-        )
-        keys = [row[0] for row in ret.fetchall()]
-        return keys
 
-    async def get(self, key: str, room: bool = True, plugin: bool = True) -> str | None:
-        if not (room or plugin):
-            raise RuntimeError('either per-room or per-plugin scope must be set')
+def _prefix_end(prefix: str) -> str | None:
+    """
+    the smallest string greater than all strings starting with prefix,
+    None if there's none.
+    """
+    # sqlite compares utf-8 bytes, which sorts like code points
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10FFFF:
+            # surrogates can't be encoded, skip them
+            following = 0xE000 if last == 0xD7FF else last + 1
+            return f"{prefix[:-1]}{chr(following)}"
+        prefix = prefix[:-1]
+    return None
+
+
+# (room, plugin) flags of the KVStore methods -> scope
+_SCOPES: dict[tuple[bool, bool], _Scope] = {
+    (True, False): _Scope.room,
+    (False, True): _Scope.plugin,
+    (True, True): _Scope.room_plugin,
+}
+
+# built once, so sqlite's statement cache always sees the same sql text.
+_STATEMENTS: dict[_Scope, _Statements] = {
+    _Scope.room: _Statements.build("room_data", ("roomid",)),
+    _Scope.plugin: _Statements.build("plugin_data", ("pluginname",)),
+    _Scope.room_plugin: _Statements.build("room_plugin_data", ("roomid", "pluginname")),
+}
+
+
+@dataclass(frozen=True)
+class StorageQuota:
+    """
+    limits for the data of each room x plugin, room and plugin. None means unlimited.
+    """
+    max_keys: int | None = None
+    max_bytes: int | None = None
 
-        qwhere = list()
-        args = list()
 
-        qwhere.append('key=?')
-        args.append(key)
+@dataclass
+class StorageUsage:
+    # None for plugin-wide data
+    room_id: str | None
+    # None for room-wide data
+    plugin_name: str | None
+    keys: int
+    bytes: int
 
-        if room:
-            table = "room_data"
-            qwhere.append('roomid=?')
-            args.append(self._room_id)
 
-        if plugin:
-            table = "plugin_data"
-            qwhere.append('pluginname=?')
-            args.append(self._plugin_name)
+# (table, *ids, key)
+type CacheKey = tuple[str, ...]
 
-        if room and plugin:
-            table = "room_plugin_data"
 
-        cur = self._db.read(
-            f"select value from {table} where {' and '.join(qwhere)};",
-            args,
-        )
-        ret = cur.fetchone()
-        if ret:
-            return ret[0]
+@dataclass(slots=True)
+class _CacheEntry:
+    value: str | None
+    # unix time
+    expires: float | None
+    # decoded json value for each type it was requested as
+    decoded: dict[Any, Any] = field(default_factory=dict)
 
-        return None
 
-    async def set(self, key: str, value: str, room: bool = True, plugin: bool = True):
-        if not (room or plugin):
-            raise RuntimeError('either per-room or per-plugin scope must be set')
+@cache
+def _type_adapter(model: Any) -> TypeAdapter:
+    # creating adapters is expensive
+    return TypeAdapter(model)
 
-        args = [key, value]
-        set_rows = ['key', 'value']
 
-        if room:
-            table = "room_data"
-            set_rows.append('roomid')
-            args.append(self._room_id)
+def _decode_json(raw: str, model: Any) -> Any:
+    if model is None:
+        return json.loads(raw)
+    return _type_adapter(model).validate_json(raw)
 
-        if plugin:
-            table = "plugin_data"
-            set_rows.append('pluginname')
-            args.append(self._plugin_name)
 
-        if room and plugin:
-            table = "room_plugin_data"
+class KVCache:
+    """
+    least-recently-used cache of key-value store entries, shared by all KVStores.
+    missing entries are cached as None.
 
-        ret = self._db.write(
-            f"insert or replace into {table}({', '.join(set_rows)}) values ({','.join('?' * len(args))});",
-            args,
-        )
-        return ret
+    a scope (table, *ids) can be marked complete when all its entries were loaded,
+    then keys without an entry are known to be missing.
+    the mark is dropped once any entry of the scope is invalidated or evicted.
+    """
 
-    async def rm(self, key: str, room: bool = True, plugin: bool = True):
-        if not (room or plugin):
-            raise RuntimeError('either per-room or per-plugin scope must be set')
+    def __init__(self, size: int) -> None:
+        self._size = size
+        self._entries: OrderedDict[CacheKey, _CacheEntry] = OrderedDict()
+        self._complete: set[CacheKey] = set()
+        # increased by each invalidation, so reads that raced with a write aren't cached.
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, key: CacheKey) -> tuple[bool, str | None]:
+        """
+        returns (found, value).
+        """
+        entry = self._entries.get(key)
+        if entry is None or self._expired(key, entry):
+            if key[:-1] in self._complete:
+                self.hits += 1
+                return True, None
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry.value
+
+    def lookup_decoded(self, key: CacheKey, model: Any) -> tuple[bool, Any]:
+        """
+        returns (found, decoded value) of a json entry previously decoded as model.
+        """
+        entry = self._entries.get(key)
+        if entry is None or model not in entry.decoded or self._expired(key, entry):
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry.decoded[model]
+
+    def store_decoded(self, key: CacheKey, value: str, model: Any, decoded: Any) -> None:
+        """
+        remember the decoded json, if the cached entry still has the value it was decoded from.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry.value == value:
+            entry.decoded[model] = decoded
+
+    def _expired(self, key: CacheKey, entry: _CacheEntry) -> bool:
+        if entry.expires is not None and entry.expires <= time.time():
+            del self._entries[key]
+            return True
+        return False
+
+    def store(self, key: CacheKey, value: str | None, generation: int, expires: float | None = None) -> None:
+        """
+        cache a value read from the database when the cache had the given generation.
+        """
+        if self._size <= 0 or generation != self._generation:
+            return
+        self._entries[key] = _CacheEntry(value, expires)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._size:
+            evicted, _ = self._entries.popitem(last=False)
+            self._complete.discard(evicted[:-1])
+
+    def is_complete(self, scope_key: CacheKey) -> bool:
+        return scope_key in self._complete
+
+    def mark_complete(self, scope_key: CacheKey, generation: int, keys: Iterable[CacheKey]) -> None:
+        """
+        all entries of the scope, with the given keys, were stored when the cache had the given generation.
+        not marked if any of them was evicted meanwhile.
+        """
+        if (self._size > 0 and generation == self._generation
+                and all(key in self._entries for key in keys)):
+            self._complete.add(scope_key)
+
+    def invalidate(self, key: CacheKey) -> None:
+        self._generation += 1
+        self._entries.pop(key, None)
+        self._complete.discard(key[:-1])
+
+    def invalidate_prefix(self, scope_key: CacheKey, prefix: str) -> None:
+        """
+        forget all entries of a scope (table, *ids) whose key starts with prefix.
+        """
+        self._generation += 1
+        self._complete.discard(scope_key)
+        size = len(scope_key)
+        for key in [key for key in self._entries
+                    if key[:size] == scope_key and len(key) == size + 1 and key[-1].startswith(prefix)]:
+            del self._entries[key]
+
+    def invalidate_table(self, table: str, room_id: str) -> None:
+        """
+        forget all entries of a room in the table.
+        """
+        self._generation += 1
+        self._complete = {scope_key for scope_key in self._complete if scope_key[:2] != (table, room_id)}
+        for key in [key for key in self._entries if key[:2] == (table, room_id)]:
+            del self._entries[key]
+
+
+class StorageBus:
+    """
+    in-process notifications about changed key-value store entries, for KVStore.watch().
+    """
 
-        args = [key]
-        qwhere = ['key=?']
+    # buffered changes per watcher, older ones are dropped
+    _QUEUE_SIZE = 16
+
+    def __init__(self) -> None:
+        self._watchers: dict[CacheKey, set[asyncio.Queue[str | None]]] = defaultdict(set)
+
+    def subscribe(self, key: CacheKey) -> asyncio.Queue[str | None]:
+        queue: asyncio.Queue[str | None] = asyncio.Queue(self._QUEUE_SIZE)
+        self._watchers[key].add(queue)
+        return queue
+
+    def unsubscribe(self, key: CacheKey, queue: asyncio.Queue[str | None]) -> None:
+        watchers = self._watchers.get(key)
+        if watchers is None:
+            return
+        watchers.discard(queue)
+        if not watchers:
+            del self._watchers[key]
+
+    def publish(self, key: CacheKey, value: str | None) -> None:
+        for queue in self._watchers.get(key, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(value)
+
+    def publish_prefix(self, scope_key: CacheKey, prefix: str) -> None:
+        """
+        notify watchers of removed keys of a scope (table, *ids) starting with prefix.
+        """
+        size = len(scope_key)
+        for key in [key for key in self._watchers
+                    if key[:size] == scope_key and len(key) == size + 1 and key[-1].startswith(prefix)]:
+            self.publish(key, None)
+
+
+class StorageQuotaExceeded(Exception):
+    """
+    raised by KVStore.set when the data would exceed the storage quota.
+    """
 
-        if room:
-            table = "room_data"
-            qwhere.append('roomid=?')
-            args.append(self._room_id)
 
-        if plugin:
-            table = "plugin_data"
-            qwhere.append('pluginname=?')
-            args.append(self._plugin_name)
+async def get_storage_usage(db: Database, limit: int) -> list[StorageUsage]:
+    """
+    the biggest storage consumers, most bytes first.
+    """
+    rows = await db.read(
+        "select roomid, pluginname, keys, bytes from storage_usage where keys > 0 "
+        "order by bytes desc limit ?;",
+        (limit,),
+    )
+    return [StorageUsage(room_id or None, plugin_name or None, keys, size)
+            for room_id, plugin_name, keys, size in rows]
 
-        if room and plugin:
-            table = "room_plugin_data"
 
-        ret = self._db.write(
-            f"delete from {table} where {' and '.join(qwhere)};",
-            args,
-        )
+class KVStore:
+    """
+    a persistent key-value store.
+
+    supports the following realms:
+    - for a plugin and a room  (try to use this)
+    - for a plugin             (for sharing across rooms)
+    - for a room               (for sharing across plugins)
+
+    with a KVCache, reads are served from memory until the entry is written.
+    """
+
+    def __init__(self, db: Database, plugin_name: str, room_id: str, *,
+                 quota: StorageQuota | None = None, cache: KVCache | None = None,
+                 bus: StorageBus | None = None):
+        self._db = db
+        self._cache = cache
+        self._bus = bus
+        self._plugin_name = plugin_name
+        self._room_id = room_id
+        self._quota = quota
+
+        # statement id parameters for each scope
+        self._scope_args: dict[_Scope, tuple[str, ...]] = {
+            _Scope.room: (room_id,),
+            _Scope.plugin: (plugin_name,),
+            _Scope.room_plugin: (room_id, plugin_name),
+        }
+        # storage_usage ids of each scope
+        self._usage_args: dict[_Scope, tuple[str, str]] = {
+            _Scope.room: (room_id, ""),
+            _Scope.plugin: ("", plugin_name),
+            _Scope.room_plugin: (room_id, plugin_name),
+        }
+
+    @staticmethod
+    def _scope(room: bool, plugin: bool) -> _Scope:
+        try:
+            return _SCOPES[(room, plugin)]
+        except KeyError:
+            raise RuntimeError('either per-room or per-plugin scope must be set') from None
+
+    async def preload(self) -> None:
+        """
+        load all entries of this room x plugin into the cache with one query,
+        then reads of them, also of missing keys, need no database access.
+        """
+        if self._cache is not None:
+            await preload(self._db, self._cache, self._plugin_name, (self._room_id,))
+
+    def transaction(self) -> AbstractAsyncContextManager[Transaction]:
+        """
+        group storage operations into one atomic database transaction:
+
+        async with api.storage.transaction():
+            await api.storage.set("a", ...)
+            await api.storage.set("b", ...)
+
+        all changes are committed together when the block is left,
+        or none of them if the block raises an exception.
+        """
+        return self._db.transaction()
+
+    async def keys(self, room: bool = True, plugin: bool = True):
+        """
+        all keys of the scope, use scan() for scopes with many keys.
+        """
+        scope = self._scope(room, plugin)
+        rows = await self._db.read(_STATEMENTS[scope].keys, (*self._scope_args[scope], time.time()))
+        keys = [row[0] for row in rows]
+        return keys
+
+    async def _scan(self, items: bool, prefix: str, *, start: str | None, end: str | None,
+                    room: bool, plugin: bool, page_size: int) -> AsyncIterator[Row]:
+        """
+        fetch the rows page by page, continuing after the last key of the previous page.
+        """
+        if page_size < 1:
+            raise ValueError("page_size must be positive")
+
+        scope = self._scope(room, plugin)
+        statements = _STATEMENTS[scope]
+        scope_args = (*self._scope_args[scope], time.time())
+
+        lower = max(prefix, start or "")
+        upper = _prefix_end(prefix) if prefix else None
+        if end is not None:
+            upper = end if upper is None else min(upper, end)
+
+        while upper is None or lower < upper:
+            if upper is None:
+                sql = statements.scan_items_from if items else statements.scan_keys_from
+                rows = await self._db.read(sql, (*scope_args, lower, page_size))
+            else:
+                sql = statements.scan_items_range if items else statements.scan_keys_range
+                rows = await self._db.read(sql, (*scope_args, lower, upper, page_size))
+
+            for row in rows:
+                yield row
+
+            if len(rows) < page_size:
+                break
+            # the smallest key after the last one
+            lower = f"{rows[-1][0]}\0"
+
+    async def scan(self, prefix: str = "", *, start: str | None = None, end: str | None = None,
+                   room: bool = True, plugin: bool = True, page_size: int = 100) -> AsyncIterator[str]:
+        """
+        iterate over the keys starting with prefix and in range [start, end), ordered by key.
+        keys are fetched page_size at a time.
+        """
+        async for (key,) in self._scan(False, prefix, start=start, end=end,
+                                       room=room, plugin=plugin, page_size=page_size):
+            yield key
+
+    async def scan_items(self, prefix: str = "", *, start: str | None = None, end: str | None = None,
+                         room: bool = True, plugin: bool = True,
+                         page_size: int = 100) -> AsyncIterator[tuple[str, str]]:
+        """
+        like scan(), but iterate over (key, value) pairs.
+        """
+        async for key, value in self._scan(True, prefix, start=start, end=end,
+                                           room=room, plugin=plugin, page_size=page_size):
+            yield key, value
+
+    def _cache_key(self, scope: _Scope, key: str) -> CacheKey:
+        return (_STATEMENTS[scope].table, *self._scope_args[scope], key)
+
+    @contextmanager
+    def _changing(self, scope: _Scope, changes: Mapping[str, str | None] | None = None,
+                  prefix: str | None = None) -> Iterator[None]:
+        """
+        wraps a write of the given keys, or keys starting with prefix.
+        afterwards, or once the write's transaction is committed,
+        cached entries are dropped and watchers notified.
+        """
+        cache, bus = self._cache, self._bus
+        changed = [(self._cache_key(scope, key), value) for key, value in (changes or {}).items()]
+        scope_key = (_STATEMENTS[scope].table, *self._scope_args[scope])
+
+        def invalidate() -> None:
+            if cache is None:
+                return
+            for cache_key, _ in changed:
+                cache.invalidate(cache_key)
+            if prefix is not None:
+                cache.invalidate_prefix(scope_key, prefix)
+
+        def committed() -> None:
+            invalidate()
+            if bus is None:
+                return
+            for cache_key, value in changed:
+                bus.publish(cache_key, value)
+            if prefix is not None:
+                bus.publish_prefix(scope_key, prefix)
+
+        try:
+            yield
+        except BaseException:
+            # the write may have been done nevertheless
+            invalidate()
+            raise
+
+        if (txn := self._db.current_transaction()) is not None:
+            txn.after_commit(committed)
+        else:
+            committed()
+
+    async def watch(self, key: str, room: bool = True, plugin: bool = True) -> AsyncIterator[str | None]:
+        """
+        yields the new value of the key (None when removed) each time it's changed through a KVStore:
+
+        async for value in api.storage.watch("key", plugin=False):
+            ...
+
+        changes are tracked once the iteration has started.
+        slow consumers may miss intermediate values, the latest one is always delivered.
+        """
+        if self._bus is None:
+            raise RuntimeError("storage change notifications are not available")
+
+        cache_key = self._cache_key(self._scope(room, plugin), key)
+        queue = self._bus.subscribe(cache_key)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._bus.unsubscribe(cache_key, queue)
+
+    async def get(self, key: str, room: bool = True, plugin: bool = True) -> str | None:
+        scope = self._scope(room, plugin)
+
+        # transactions may see their own uncommitted writes, so they bypass the cache
+        cache = self._cache if self._db.current_transaction() is None else None
+        if cache is not None:
+            cache_key = self._cache_key(scope, key)
+            found, value = cache.lookup(cache_key)
+            if found:
+                return value
+            generation = cache.generation
+
+        ret = await self._db.read_one(_STATEMENTS[scope].get, (*self._scope_args[scope], time.time(), key))
+        value, expires = ret if ret else (None, None)
+
+        if cache is not None:
+            cache.store(cache_key, value, generation, expires)
+        return value
+
+    @overload
+    async def get_json[T](self, key: str, model: type[T], room: bool = True, plugin: bool = True) -> T | None: ...
+
+    @overload
+    async def get_json(self, key: str, model: None = None, room: bool = True, plugin: bool = True) -> Any: ...
+
+    async def get_json(self, key: str, model: Any = None, room: bool = True, plugin: bool = True) -> Any:
+        """
+        fetch and decode a json value, None if the key is missing.
+        with a model type (e.g. a pydantic model or `list[Model]`), the value is validated as that type.
+
+        the decoded value is cached until the key is written,
+        so the returned object is shared: copy it before modifying it.
+        """
+        scope = self._scope(room, plugin)
+        cache = self._cache if self._db.current_transaction() is None else None
+        if cache is not None:
+            found, decoded = cache.lookup_decoded(self._cache_key(scope, key), model)
+            if found:
+                return decoded
+
+        raw = await self.get(key, room=room, plugin=plugin)
+        if raw is None:
+            return None
+
+        decoded = _decode_json(raw, model)
+        if cache is not None:
+            cache.store_decoded(self._cache_key(scope, key), raw, model, decoded)
+        return decoded
+
+    async def set_json(self, key: str, value: Any, room: bool = True, plugin: bool = True):
+        """
+        store the value as json. pydantic models and dataclasses are supported, also nested.
+        """
+        return await self.set(key, pydantic_core.to_json(value).decode(), room=room, plugin=plugin)
+
+    async def get_many(self, keys: Iterable[str], room: bool = True, plugin: bool = True) -> dict[str, str | None]:
+        """
+        fetch the values of all given keys in one query, None for missing keys.
+        """
+        scope = self._scope(room, plugin)
+        ret: dict[str, str | None] = dict.fromkeys(keys)
+
+        cache = self._cache if self._db.current_transaction() is None else None
+        missing = list(ret)
+        if cache is not None:
+            missing = list()
+            for key in ret:
+                found, value = cache.lookup(self._cache_key(scope, key))
+                if found:
+                    ret[key] = value
+                else:
+                    missing.append(key)
+            generation = cache.generation
+
+        if missing:
+            rows = await self._db.read(_STATEMENTS[scope].get_many,
+                                       (*self._scope_args[scope], time.time(), json.dumps(missing)))
+            expiry: dict[str, float | None] = dict()
+            for key, value, expires in rows:
+                ret[key] = value
+                expiry[key] = expires
+
+            if cache is not None:
+                for key in missing:
+                    cache.store(self._cache_key(scope, key), ret[key], generation, expiry.get(key))
+
         return ret
+
+    async def _check_quota(self, scope: _Scope, entries: dict[str, str]) -> None:
+        """
+        raise StorageQuotaExceeded if storing the entries would exceed the quota.
+        concurrent sets may exceed it a little, unless they're done in a transaction.
+        """
+        quota = self._quota
+        if quota is None or (quota.max_keys is None and quota.max_bytes is None):
+            return
+
+        error = await self._quota_error(quota, scope, entries)
+        # the usage still counts expired entries until they're deleted,
+        # so delete the scope's ones now instead of waiting for that.
+        if error is not None and await self._db.write(_STATEMENTS[scope].expire_scope,
+                                                      (*self._scope_args[scope], time.time())):
+            error = await self._quota_error(quota, scope, entries)
+        if error is not None:
+            raise StorageQuotaExceeded(error)
+
+    async def _quota_error(self, quota: StorageQuota, scope: _Scope, entries: dict[str, str]) -> str | None:
+        row = await self._db.read_one(
+            _STATEMENTS[scope].usage,
+            (*self._scope_args[scope], json.dumps(list(entries)), *self._usage_args[scope]),
+        )
+        keys, size, old_keys, old_size = row if row else (0, 0, 0, 0)
+
+        new_keys = keys + len(entries) - old_keys
+        new_size = size - old_size + sum(len(key.encode()) + len(value.encode())
+                                         for key, value in entries.items())
+
+        room_id, plugin_name = self._usage_args[scope]
+        owner = " in ".join(filter(None, (f"plugin {plugin_name}" if plugin_name else "",
+                                          f"room {room_id}" if room_id else "")))
+        if quota.max_keys is not None and new_keys > max(quota.max_keys, keys):
+            return f"storage quota of {owner} exceeded: {new_keys} keys, only {quota.max_keys} allowed"
+        if quota.max_bytes is not None and new_size > max(quota.max_bytes, size):
+            return f"storage quota of {owner} exceeded: {new_size} bytes, only {quota.max_bytes} allowed"
+        return None
+
+    async def set(self, key: str, value: str, room: bool = True, plugin: bool = True, ttl: float | None = None):
+        """
+        store the value for the key.
+        with a ttl, the entry is removed after that many seconds.
+        raises StorageQuotaExceeded if the data would exceed the storage quota.
+        """
+        scope = self._scope(room, plugin)
+        await self._check_quota(scope, {key: value})
+        expires = _expiry(ttl)
+        with self._changing(scope, {key: value}):
+            return await self._db.write(_STATEMENTS[scope].set, (*self._scope_args[scope], key, value, expires))
+
+    async def set_many(self, entries: Mapping[str, str], room: bool = True, plugin: bool = True,
+                       ttl: float | None = None) -> int:
+        """
+        store all entries with one commit, optionally expiring after ttl seconds.
+        raises StorageQuotaExceeded if the data would exceed the storage quota, then nothing is stored.
+        """
+        scope = self._scope(room, plugin)
+        entries = dict(entries)
+        if not entries:
+            return 0
+
+        await self._check_quota(scope, entries)
+        scope_args = self._scope_args[scope]
+        expires = _expiry(ttl)
+        with self._changing(scope, entries):
+            return await self._db.write_many(_STATEMENTS[scope].set,
+                                             ((*scope_args, key, value, expires) for key, value in entries.items()))
+
+    async def rm(self, key: str, room: bool = True, plugin: bool = True):
+        scope = self._scope(room, plugin)
+        with self._changing(scope, {key: None}):
+            return await self._db.write(_STATEMENTS[scope].rm, (*self._scope_args[scope], key))
+
+    async def delete_prefix(self, prefix: str, room: bool = True, plugin: bool = True) -> int:
+        """
+        remove all keys starting with prefix, returns the number of removed keys.
+        """
+        scope = self._scope(room, plugin)
+        scope_args = self._scope_args[scope]
+        with self._changing(scope, prefix=prefix):
+            if (end := _prefix_end(prefix)) is not None:
+                return await self._db.write(_STATEMENTS[scope].rm_range, (*scope_args, prefix, end))
+            return await self._db.write(_STATEMENTS[scope].rm_from, (*scope_args, prefix))
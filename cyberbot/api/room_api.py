@@ -7,13 +7,15 @@ from typing import TYPE_CHECKING, Awaitable, Callable
 
 from nio.events.room_events import Event
 
-from .kvstore import KVStore
+from .kvstore import KVStore, get_storage_usage
 from .text_handler import TextHandler
 from .types import MessageText
 
 if TYPE_CHECKING:
+    from ..db_stats import StatementSummary
     from ..room_module import RoomModule
     from .bot import Bot
+    from .kvstore import StorageUsage
     from .room import Room
     from .service import Service
 
@@ -28,7 +30,8 @@ class RoomAPI:
 
         self._bot = bot
         self._room = room
-        self._kv = KVStore(bot.db, plugin_name, room.room_id)
+        self._kv = KVStore(bot.db, plugin_name, room.room_id,
+                           quota=bot.storage_quota, cache=bot.kv_cache, bus=bot.storage_bus)
 
         self._tasks: set[asyncio.Task] = set()
 
@@ -128,8 +131,19 @@ class RoomAPI:
     async def send_notice(self, txt):
         return await self._room.send_text(txt, notice=True)
 
-    async def send_html(self, html: str, text: str = "", notice=False):
-        return await self._room.send_html(text=text, html=html, notice=notice)
+    async def send_html(self, html: str, text: str = "", notice=False, coalesce: bool = True):
+        """
+        returns the event id of the message, or None if sending failed.
+        coalesce: notices may be merged with others sent at about the same time.
+                  don't for messages that are edited later.
+        """
+        return await self._room.send_html(text=text, html=html, notice=notice, coalesce=coalesce)
+
+    async def edit_html(self, event_id: str, html: str, text: str = "", notice=False):
+        """
+        replace the content of a message sent before.
+        """
+        return await self._room.edit_text(event_id, text=text, html=html, notice=notice)
 
     # private chat
     async def send_text_to_user(
@@ -177,6 +191,12 @@ class RoomAPI:
                 ret[room_id] = room
         return ret
 
+    def get_configurable_rooms(self, user_id: str, power_level: int | None = None) -> dict[str, Room]:
+        """
+        fetch all rooms the user may configure, with the given power level.
+        """
+        return self._bot.rooms.configurable_rooms(user_id, power_level)
+
     def get_room(self, room_id: str) -> Room | None:
         """
         fetch any known room
@@ -206,6 +226,39 @@ class RoomAPI:
     async def get_available_plugins(self) -> dict[str, RoomModule]:
         return self._bot.get_plugins()
 
+    # bot administration
+    def is_bot_admin(self, user_id: str) -> bool:
+        """
+        is the user configured as admin of the whole bot?
+        """
+        return self._bot.is_admin(user_id)
+
+    def get_db_stats(self) -> list[StatementSummary]:
+        """
+        timing statistics of database statements, most total time first.
+        """
+        return self._bot.db.stats.summary()
+
+    async def get_storage_usage(self, limit: int) -> list[StorageUsage]:
+        """
+        the rooms and plugins which store the most data.
+        """
+        return await get_storage_usage(self._bot.db, limit)
+
+    def get_kv_cache_stats(self) -> tuple[int, int, int]:
+        """
+        plugin storage cache (entries, hits, misses).
+        """
+        cache = self._bot.kv_cache
+        return len(cache), cache.hits, cache.misses
+
+    def get_power_level_stats(self) -> tuple[int, int]:
+        """
+        user power level lookups (hits, misses), misses needed a homeserver request.
+        """
+        rooms = self._bot.rooms
+        return rooms.power_level_hits, rooms.power_level_misses
+
     # task management
     async def start_repeating_task(
         self,
@@ -17,6 +17,10 @@ class RoomPlugin(abc.ABC):
     This is instanced once per plugin per room.
     """
 
+    # load the plugin's room storage into the cache before init(),
+    # for plugins that read many of their keys at startup.
+    preload_storage: bool = False
+
     @classmethod
     @abc.abstractmethod
     def about(cls) -> str:
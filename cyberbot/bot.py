@@ -10,14 +10,17 @@ from typing import Any
 import nio
 from nio import events
 
+from .api.kvstore import KVCache, StorageBus, StorageQuota
 from .api.room_plugin import RoomPlugin
 from .api.service import Service
 from .config import Config
 from .database import Database
+from .db_backend import FileBackend, MemoryBackend, StorageBackend
 from .module_loader import load_modules
 from .room import Room
 from .room_tracker import RoomTracker
-from .service import github, gitlab, http_server, invite_manager
+from .send_scheduler import SendScheduler
+from .service import db_maintenance, github, gitlab, http_server, invite_manager, storage_expiry
 
 logger = logging.getLogger(__name__)
 
@@ -26,7 +29,24 @@ class Bot:
     def __init__(self, config: Config):
         self._config = config
 
-        self._db = Database(config.storage.database_path)
+        backend: StorageBackend
+        match config.storage.backend:
+            case "file":
+                backend = FileBackend(config.storage.database_path)
+            case "memory":
+                backend = MemoryBackend(config.storage.database_path, config.storage.snapshot_interval_s)
+
+        self._db = Database(
+            backend,
+            wal=config.storage.wal,
+            read_connections=config.storage.read_connections,
+            commit_window=config.storage.commit_window_ms / 1000,
+            slow_threshold=(config.storage.slow_query_ms / 1000
+                            if config.storage.slow_query_ms is not None else None),
+        )
+        self._storage_quota = StorageQuota(config.storage.quota_keys, config.storage.quota_bytes)
+        self._kv_cache = KVCache(config.storage.kv_cache_size)
+        self._storage_bus = StorageBus()
         self._own_user_id = config.matrix.user
 
         client_config = nio.AsyncClientConfig(
@@ -41,6 +61,14 @@ class Bot:
             store_path=str(config.storage.cryptostate_path),
             config=client_config,
         )
+        self._send_scheduler = SendScheduler(
+            self._client.room_send,
+            rate=config.bot.send_rate,
+            burst=config.bot.send_burst,
+            retries=config.bot.send_retries,
+            coalesce_window=config.bot.send_coalesce_ms / 1000,
+            coalesce_bytes=config.bot.send_coalesce_bytes,
+        )
 
         self._password = config.matrix.password
         self.botname = config.bot.name
@@ -52,7 +80,7 @@ class Bot:
                 raise ValueError(
                     f"invalid allowed room. it must start with '!' and contain ':' -> {room!r}"
                 )
-        self.rooms = RoomTracker(self)
+        self.rooms = RoomTracker(self, setup_concurrency=config.bot.room_setup_concurrency)
 
         self._available_plugins: dict[str, type[RoomPlugin]] = dict()
 
@@ -65,6 +93,8 @@ class Bot:
             "gitlab_hook_server": gitlab.GitLabServer(self),
             "github_hook_server": github.GitHubServer(self),
             "invite_manager": invite_manager.InviteManager(self),
+            "db_maintenance": db_maintenance.DatabaseMaintenance(self),
+            "storage_expiry": storage_expiry.StorageExpiry(self),
         }
 
     def get_plugins(self) -> dict[str, type[RoomPlugin]]:
@@ -85,10 +115,26 @@ class Bot:
     def db(self) -> Database:
         return self._db
 
+    @property
+    def storage_quota(self) -> StorageQuota:
+        return self._storage_quota
+
+    @property
+    def kv_cache(self) -> KVCache:
+        return self._kv_cache
+
+    @property
+    def storage_bus(self) -> StorageBus:
+        return self._storage_bus
+
     @property
     def mxclient(self) -> nio.AsyncClient:
         return self._client
 
+    @property
+    def send_scheduler(self) -> SendScheduler:
+        return self._send_scheduler
+
     @property
     def user_id(self) -> str:
         return self._own_user_id
@@ -120,13 +166,13 @@ class Bot:
 
         access_token_checked = False
 
-        login_props_raw = self._db.read(
+        login_props_raw = await self._db.read(
             "select key, value from state where key in "
             "('login_user_id', 'login_token', 'login_device_id')"
-        ).fetchall()
+        )
 
         if login_props_raw:
-            login_props = dict(login_props_raw)
+            login_props: dict[str, str] = dict(login_props_raw)
             # reuse previous login token
             token = login_props.get("login_token")
 
@@ -169,7 +215,7 @@ class Bot:
                 raise RuntimeError(f"Error logging in: {response}")
             elif isinstance(response, nio.LoginResponse):
                 # persist the new access token
-                self._db.write_many(
+                await self._db.write_many(
                     "insert or replace into state(key, value) values (?, ?)",
                     [
                         ("login_user_id", response.user_id),
@@ -225,7 +271,7 @@ class Bot:
         return True
 
     async def __aenter__(self):
-        self._db.migrate()
+        await self._db.migrate()
         try:
             await self._login()
         except Exception:
@@ -235,7 +281,9 @@ class Bot:
         return self
 
     async def __aexit__(self, exc_type, exc_value, exc_tb):
+        await self._send_scheduler.close()
         await self._client.close()
+        await self._db.close()
 
     async def _load_rooms(self):
         logger.info("Loading rooms...")
@@ -445,6 +493,11 @@ class Bot:
             case events.RoomMemberEvent():
                 await self._on_room_member_event(room, event)
 
+            case events.PowerLevelsEvent():
+                # nio has already applied it to the room state
+                if active_room := self.rooms.get(room.room_id):
+                    active_room.on_power_levels_event()
+
             case events.MegolmEvent():
                 # "MegolmEvents are presented to library users only if the library fails
                 # to decrypt the event because of a missing session key."
@@ -474,6 +527,11 @@ class Bot:
     async def _on_kick_response(self, response):
         logger.info(f"kick response: {response!r}")
 
+    async def _on_error_response(self, response: nio.ErrorResponse):
+        # nio retries rate limited requests itself, but all sends should wait.
+        if response.status_code == "M_LIMIT_EXCEEDED":
+            self._send_scheduler.rate_limited(response.retry_after_ms)
+
     async def _listen(self):
         logger.debug("setting up matrix event callbacks...")
         self._client.add_event_callback(self._on_event, nio.RoomEvent)
@@ -482,6 +540,8 @@ class Bot:
             self._on_global_account_data, nio.AccountDataEvent
         )
 
+        self._client.add_response_callback(self._on_error_response, nio.ErrorResponse)
+
         logger.info(f"{self.botname} ready for action!")
 
         # process all new events since our initial sync
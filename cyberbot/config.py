@@ -1,16 +1,36 @@
 import os
 import re
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal
 
 import yaml
-from pydantic import BaseModel, field_validator
+from pydantic import BaseModel, NonNegativeFloat, NonNegativeInt, PositiveFloat, PositiveInt, field_validator
 
 
 class StorageConfig(BaseModel):
     database_path: Path
     cryptostate_path: Path
 
+    # "file": the database is stored in database_path.
+    # "memory": the database is kept in memory, and snapshotted to database_path.
+    backend: Literal["file", "memory"] = "file"
+    # memory backend: snapshot after commits at most this often, None for shutdown only
+    snapshot_interval_s: PositiveFloat | None = 60
+
+    # use sqlite's write-ahead-log, so reads can proceed while a write commits.
+    wal: bool = False
+    # number of read-only database connections in wal mode
+    read_connections: PositiveInt = 4
+    # writes issued within this time window are committed in one transaction
+    commit_window_ms: NonNegativeFloat = 2
+    # log statements that take longer than this, None to disable
+    slow_query_ms: NonNegativeFloat | None = 100
+    # storage limits of each plugin in each room, None for unlimited
+    quota_keys: PositiveInt | None = None
+    quota_bytes: PositiveInt | None = None
+    # number of plugin storage entries cached in memory, 0 to disable
+    kv_cache_size: NonNegativeInt = 10000
+
     def set_paths(self, basedir: Path):
         self.database_path = basedir / self.database_path
         if not self.database_path.parent.is_dir():
@@ -41,6 +61,19 @@ class BotConfig(BaseModel):
     rooms_allowed: list[str]
     admins: list[str]
 
+    # rooms set up and initialized in parallel at startup
+    room_setup_concurrency: PositiveInt = 16
+
+    # messages sent per second on average over all rooms, and in bursts
+    send_rate: PositiveFloat = 5
+    send_burst: PositiveInt = 10
+    # retries of a failed message send
+    send_retries: NonNegativeInt = 3
+    # notices to a room within this time are merged into one message, 0 to disable
+    send_coalesce_ms: NonNegativeFloat = 0
+    # up to this size in bytes
+    send_coalesce_bytes: PositiveInt = 16384
+
 
 class Config(BaseModel):
     storage: StorageConfig
@@ -1,102 +1,523 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
 import logging
 import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from .db_backend import FileBackend, StorageBackend
+from .db_maintenance import run_task
+from .db_stats import StatementStats
+from .migrations import DATA_MIGRATIONS, MIGRATIONS
+
+if TYPE_CHECKING:
+    from types import FrameType
+    from typing import AsyncIterator, Callable, Iterable, Sequence
+
+    from .db_maintenance import MaintenanceResult, MaintenanceTask
+    from .db_stats import Caller
+    from .migrations import DataMigration, Migration
 
 logger = logging.getLogger(__name__)
 
+# the transaction of the current task, see Database.transaction()
+_current_transaction: contextvars.ContextVar[Transaction | None] = contextvars.ContextVar(
+    "current_transaction", default=None
+)
+
+
+type Row = tuple[Any, ...]
+
+
+def _get_caller() -> Caller | None:
+    """
+    find the first stack frame outside of this module, for the slow statement log.
+    """
+    frame: FrameType | None = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+@dataclass
+class _PendingWrite:
+    """
+    a write waiting in the group commit queue.
+    """
+    sql: str
+    params: Any
+    many: bool
+    future: asyncio.Future[int]
+    caller: Caller | None
+
+
+class Transaction:
+    """
+    handle to an open database transaction, obtained by `async with db.transaction() as txn`.
+    all statements are executed in the same sqlite transaction and committed once at the end.
+    """
+
+    def __init__(self, db: Database):
+        self._db = db
+        self._closed = False
+        # nesting level of savepoints
+        self._depth = 0
+        self._after_commit: list[Callable[[], None]] = list()
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """
+        call the function once the transaction is committed.
+        """
+        self._after_commit.append(callback)
+
+    @asynccontextmanager
+    async def _savepoint(self) -> AsyncIterator[None]:
+        """
+        nested transaction block: only its own changes are undone on exceptions.
+        """
+        self._depth += 1
+        name = f"nested_{self._depth}"
+        run, execute = self._db._run, self._db._connection.execute
+        await run(execute, f"savepoint {name};")
+        try:
+            yield
+        except BaseException:
+            await run(execute, f"rollback to {name};")
+            raise
+        finally:
+            await run(execute, f"release {name};")
+            self._depth -= 1
+
+    async def read(self, sql: str, params: Any = ()) -> list[Row]:
+        logger.debug("txn reading sql: %s <- %s", sql, params)
+        return await self._db._run(self._db._execute_fetch, sql, params, _get_caller())
+
+    async def read_one(self, sql: str, params: Any = ()) -> Row | None:
+        rows = await self.read(sql, params)
+        return rows[0] if rows else None
+
+    async def write(self, sql: str, params: Any = ()) -> int:
+        logger.debug("txn writing sql: %s <- %s", sql, params)
+        return await self._db._run(self._db._execute, sql, params, _get_caller())
+
+    async def write_many(self, sql: str, paramlist: Iterable[Any] = ()) -> int:
+        paramlist = list(paramlist)
+        logger.debug("txn writing-many sql: %s <- %s", sql, paramlist)
+        return await self._db._run(self._db._execute_many, sql, paramlist, _get_caller())
+
 
 class Database:
-    def __init__(self, path: Path):
-        self._dbpath = path
-        self._connection: sqlite3.Connection = sqlite3.connect(path, autocommit=False)
-        self._connection.execute("PRAGMA foreign_keys = ON;")
+    """
+    sqlite storage of the bot.
 
-    def cursor(self) -> sqlite3.Cursor:
-        return self._connection.cursor()
+    the database is stored by the given backend, a path means a FileBackend.
+    the sqlite connection lives in a dedicated thread, so disk io and fsyncs
+    never block the asyncio event loop. all methods are awaitable.
 
-    def read(self, sql, params={}) -> sqlite3.Cursor:
-        logger.debug("reading sql: %s <- %s", sql, params)
-        ret = self._connection.execute(sql, params)
-        if self._connection.in_transaction:
+    with wal=True, the database uses sqlite's write-ahead-log journal mode.
+    reads are then done by a pool of read-only connections,
+    which can proceed while the writer connection commits.
+
+    writes are group-committed: all writes issued within commit_window seconds,
+    or while the previous batch commits, are stored in one transaction.
+
+    the duration of each statement is recorded in `stats`,
+    statements slower than slow_threshold seconds are logged.
+    """
+
+    def __init__(self, backend: StorageBackend | Path, wal: bool = False, read_connections: int = 4,
+                 commit_window: float = 0.002, slow_threshold: float | None = 0.1):
+        if isinstance(backend, Path):
+            backend = FileBackend(backend)
+        if wal and not backend.supports_readers:
+            raise ValueError(f"wal mode is not supported by {type(backend).__name__}")
+        self._backend = backend
+        self._wal = wal
+
+        self.stats = StatementStats(slow_threshold)
+
+        # all sqlite writes are done in this thread.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        self._connection: sqlite3.Connection = self._executor.submit(self._connect).result()
+
+        # only one transaction may use the writer connection at a time
+        self._lock = asyncio.Lock()
+
+        # group commit queue
+        self._commit_window = commit_window
+        self._pending_writes: list[_PendingWrite] = list()
+        self._flush_task: asyncio.Task | None = None
+
+        self._data_migration_task: asyncio.Task | None = None
+
+        # when the last statement was issued, for idle detection
+        self._last_activity = time.monotonic()
+
+        # wal mode: read-only connections, one per reader thread
+        self._readers: ThreadPoolExecutor | None = None
+        self._reader_local = threading.local()
+        self._reader_connections: list[sqlite3.Connection] = list()
+        self._reader_connections_lock = threading.Lock()
+        if wal:
+            if read_connections < 1:
+                raise ValueError("wal mode needs at least one read connection")
+            self._readers = ThreadPoolExecutor(max_workers=read_connections,
+                                               thread_name_prefix="database-reader")
+
+    def _connect(self) -> sqlite3.Connection:
+        # pragmas can't be changed within transactions
+        connection = self._backend.connect()
+        connection.execute("PRAGMA foreign_keys = ON;")
+        # `insert or replace` runs delete triggers for replaced rows, for storage usage accounting
+        connection.execute("PRAGMA recursive_triggers = ON;")
+        # store temporary tables in memory only
+        connection.execute("PRAGMA temp_store = MEMORY;")
+        # free pages can be given back by maintenance.
+        # only has an effect on new databases, existing ones would need a full vacuum.
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        if self._wal:
+            # persistent setting in the database file
+            connection.execute("PRAGMA journal_mode = WAL;")
+        connection.autocommit = False
+        return connection
+
+    def _reader_connection(self) -> sqlite3.Connection:
+        """
+        get the read-only connection of the current reader thread.
+        """
+        connection: sqlite3.Connection | None = getattr(self._reader_local, "connection", None)
+        if connection is None:
+            connection = self._backend.connect_reader()
+            self._reader_local.connection = connection
+            with self._reader_connections_lock:
+                self._reader_connections.append(connection)
+        return connection
+
+    async def _run[T](self, func: Callable[..., T], *args: Any) -> T:
+        """
+        run the function in the database thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    # functions below are called in the database thread
+    def _execute_fetch(self, sql: str, params: Any, caller: Caller | None) -> list[Row]:
+        start = time.perf_counter()
+        rows = self._connection.execute(sql, params).fetchall()
+        self.stats.record(sql, time.perf_counter() - start, caller)
+        return rows
+
+    def _execute(self, sql: str, params: Any, caller: Caller | None) -> int:
+        start = time.perf_counter()
+        rowcount = self._connection.execute(sql, params).rowcount
+        self.stats.record(sql, time.perf_counter() - start, caller)
+        return rowcount
+
+    def _execute_many(self, sql: str, paramlist: list[Any], caller: Caller | None) -> int:
+        start = time.perf_counter()
+        rowcount = self._connection.executemany(sql, paramlist).rowcount
+        self.stats.record(sql, time.perf_counter() - start, caller)
+        return rowcount
+
+    def _commit(self) -> None:
+        start = time.perf_counter()
+        self._connection.commit()
+        self.stats.record("commit", time.perf_counter() - start)
+        self._backend.committed(self._connection)
+
+    def _close(self) -> None:
+        self._backend.close(self._connection)
+        self._connection.close()
+
+    def _read(self, sql: str, params: Any, caller: Caller | None) -> list[Row]:
+        try:
+            return self._execute_fetch(sql, params, caller)
+        finally:
+            if self._connection.in_transaction:
+                self._connection.rollback()
+
+    def _read_pooled(self, sql: str, params: Any, caller: Caller | None) -> list[Row]:
+        start = time.perf_counter()
+        rows = self._reader_connection().execute(sql, params).fetchall()
+        self.stats.record(sql, time.perf_counter() - start, caller)
+        return rows
+
+    def _maintain(self, task: MaintenanceTask, time_limit: float) -> MaintenanceResult:
+        # vacuum and checkpoints can't run within a transaction
+        self._connection.autocommit = True
+        try:
+            result = run_task(self._connection, task, time_limit, self._wal)
+        finally:
+            self._connection.autocommit = False
+        self._backend.committed(self._connection)
+        return result
+
+    def _write_batch(self, batch: list[_PendingWrite]) -> list[int | sqlite3.Error]:
+        """
+        execute the writes in one transaction.
+        each write gets a savepoint, so one failing statement doesn't affect the others.
+        """
+        results: list[int | sqlite3.Error] = list()
+        try:
+            for write in batch:
+                self._connection.execute("savepoint pending_write;")
+                try:
+                    if write.many:
+                        results.append(self._execute_many(write.sql, write.params, write.caller))
+                    else:
+                        results.append(self._execute(write.sql, write.params, write.caller))
+                except sqlite3.Error as exc:
+                    self._connection.execute("rollback to pending_write;")
+                    results.append(exc)
+                self._connection.execute("release pending_write;")
+
+            self._commit()
+        except BaseException:
             self._connection.rollback()
-        return ret
+            raise
+        return results
+
+    # event loop side api
+    def current_transaction(self) -> Transaction | None:
+        """
+        the transaction block the current task is in, if any.
+        """
+        txn = _current_transaction.get()
+        if txn is not None and txn._db is self and not txn._closed:
+            return txn
+        return None
+
+    async def read(self, sql: str, params: Any = ()) -> list[Row]:
+        if (txn := self.current_transaction()) is not None:
+            return await txn.read(sql, params)
+
+        self._last_activity = time.monotonic()
+        logger.debug("reading sql: %s <- %s", sql, params)
+        if self._readers is not None:
+            # reads don't wait for the writer
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._readers, self._read_pooled, sql, params, _get_caller())
+
+        async with self._lock:
+            return await self._run(self._read, sql, params, _get_caller())
+
+    async def read_one(self, sql: str, params: Any = ()) -> Row | None:
+        rows = await self.read(sql, params)
+        return rows[0] if rows else None
+
+    async def write(self, sql: str, params: Any = ()) -> int:
+        """
+        execute and commit one statement, returns the number of modified rows.
+        returns once the write is committed.
+        """
+        if (txn := self.current_transaction()) is not None:
+            return await txn.write(sql, params)
 
-    def write(self, sql, params={}) -> sqlite3.Cursor:
         logger.debug("writing sql: %s <- %s", sql, params)
-        ret = self._connection.execute(sql, params)
-        self._connection.commit()
-        return ret
+        return await self._enqueue_write(sql, params, many=False)
 
-    def write_many(self, sql, paramlist=[]) -> sqlite3.Cursor:
+    async def write_many(self, sql: str, paramlist: Iterable[Any] = ()) -> int:
+        if (txn := self.current_transaction()) is not None:
+            return await txn.write_many(sql, paramlist)
+
+        # materialize generators here, not in the database thread.
+        paramlist = list(paramlist)
         logger.debug("writing-many sql: %s <- %s", sql, paramlist)
-        ret = self._connection.executemany(sql, paramlist)
-        self._connection.commit()
-        return ret
+        return await self._enqueue_write(sql, paramlist, many=True)
+
+    async def _enqueue_write(self, sql: str, params: Any, many: bool) -> int:
+        self._last_activity = time.monotonic()
+        future: asyncio.Future[int] = asyncio.get_running_loop().create_future()
+        self._pending_writes.append(_PendingWrite(sql, params, many, future, _get_caller()))
+
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_writes())
+
+        return await future
+
+    async def _flush_writes(self) -> None:
+        """
+        commit queued writes in batches until the queue is empty.
+        """
+        try:
+            while self._pending_writes:
+                if self._commit_window > 0:
+                    # gather more writes
+                    await asyncio.sleep(self._commit_window)
+
+                async with self._lock:
+                    batch, self._pending_writes = self._pending_writes, list()
+                    logger.debug("committing %d writes", len(batch))
+                    try:
+                        results = await self._run(self._write_batch, batch)
+                    except Exception as exc:
+                        for write in batch:
+                            if not write.future.done():
+                                write.future.set_exception(exc)
+                        continue
+
+                for write, result in zip(batch, results):
+                    if write.future.done():
+                        # the writer was cancelled
+                        continue
+                    if isinstance(result, sqlite3.Error):
+                        write.future.set_exception(result)
+                    else:
+                        write.future.set_result(result)
+        finally:
+            self._flush_task = None
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        """
+        group multiple statements into one transaction.
+        it's committed when the block is left, and rolled back on exceptions.
+
+        while the block is active, all read/write calls of this database from the same task
+        (and tasks created in it) are done in this transaction, too.
+        nested transaction blocks become savepoints.
 
-    def migrate(self):
+        the block holds the database lock, so no other statement runs until it's left.
+        don't await network io or other slow things in it.
+        """
+        if (outer := self.current_transaction()) is not None:
+            async with outer._savepoint():
+                yield outer
+            return
+
+        self._last_activity = time.monotonic()
+        async with self._lock:
+            txn = Transaction(self)
+            token = _current_transaction.set(txn)
+            try:
+                yield txn
+            except BaseException:
+                await self._run(self._connection.rollback)
+                raise
+            finally:
+                txn._closed = True
+                _current_transaction.reset(token)
+
+            # the commit goes on in the database thread when we're cancelled,
+            # so the callbacks have to run then, too, or caches miss the changes.
+            await asyncio.shield(self._commit_transaction(txn))
+
+    async def _commit_transaction(self, txn: Transaction) -> None:
+        await self._run(self._commit)
+        for callback in txn._after_commit:
+            callback()
+
+    def idle_time(self) -> float:
+        """
+        seconds since the last statement was issued.
+        """
+        return time.monotonic() - self._last_activity
+
+    async def maintain(self, task: MaintenanceTask, time_limit: float) -> MaintenanceResult:
+        """
+        run a housekeeping task in the database thread, interrupted after time_limit seconds.
+        other statements wait until it's done.
+        """
+        async with self._lock:
+            return await self._run(self._maintain, task, time_limit)
+
+    async def close(self) -> None:
+        if self._data_migration_task is not None:
+            # it's continued at next startup
+            self._data_migration_task.cancel()
+            try:
+                await self._data_migration_task
+            except asyncio.CancelledError:
+                pass
+
+        if self._flush_task is not None:
+            await self._flush_task
+
+        if self._readers is not None:
+            self._readers.shutdown()
+            for connection in self._reader_connections:
+                connection.close()
+            self._reader_connections.clear()
+
+        async with self._lock:
+            await self._run(self._close)
+        self._executor.shutdown()
+
+    async def migrate(
+        self,
+        migrations: Sequence[Migration] = MIGRATIONS,
+        data_migrations: Sequence[DataMigration] = DATA_MIGRATIONS,
+    ) -> None:
         """
         transform the database schema to the latest version.
+        pending data migrations are then continued in the background.
         """
-        c = self._connection.cursor()
-
-        c.executescript(
-            """
-            -- store temporary tables in memory only
-            pragma temp_store = MEMORY;
-
-            -- room_plugins: which plugins are activated in which room
-            create table if not exists room_plugins (
-                roomid     text,
-                pluginname text,
-                primary key (roomid, pluginname)
-            ) strict;
-
-            -- global room data
-            create table if not exists room_data (
-                roomid     text,
-                key        text,
-                value      text,
-                primary key (roomid, key)
-            ) strict;
-
-            -- plugin_data: global plugin data
-            create table if not exists plugin_data (
-                pluginname text,
-                key        text,
-                value      text,
-                primary key (pluginname, key)
-            ) strict;
-
-            -- data local to a plugin x room combination
-            create table if not exists room_plugin_data (
-                roomid     text,
-                pluginname text,
-                key        text,
-                value      text,
-                primary key (roomid, pluginname, key)
-            ) strict;
-
-            -- global bot information such as login token
-            create table if not exists state (
-                key   text primary key,
-                value text
-            ) strict;
-
-            -- mapping of interaction rooms and its config rooms
-            create table if not exists config_room (
-                source_roomid text,
-                target_roomid text
-            ) strict;
-            create index if not exists idx_config_rooms_source_roomid on config_room(source_roomid);
-            create index if not exists idx_config_rooms_target_roomid on config_room(target_roomid);
-            create unique index if not exists uidx_config_rooms_source_target_roomid
-                on config_room(source_roomid, target_roomid);
-
-            -- who may configure which room
-            create table if not exists config_acl (
-                roomid text primary key,
-                acl text
-            ) strict;
-            """
-        )
+        async with self._lock:
+            version = await self._run(self._schema_version)
+
+            if version > len(migrations):
+                raise RuntimeError(f"database schema version {version} is newer than supported "
+                                   f"version {len(migrations)}")
+
+            if version < len(migrations):
+                for new_version, migration in enumerate(migrations[version:], start=version + 1):
+                    logger.info("migrating database to version %d: %s", new_version, migration.description)
+                    await self._run(self._apply_migration, migration, new_version)
+            else:
+                logger.debug("database schema version %d is up to date", version)
+
+        if data_migrations:
+            done = {row[0] for row in await self.read(
+                "select key from state where key like 'data_migration:%';"
+            )}
+            pending = [migration for migration in data_migrations
+                       if f"data_migration:{migration.name}" not in done]
+            if pending:
+                self._data_migration_task = asyncio.create_task(self._run_data_migrations(pending))
+
+    def _schema_version(self) -> int:
+        return self._connection.execute("pragma user_version;").fetchone()[0]
+
+    def _apply_migration(self, migration: Migration, version: int) -> None:
+        # runs in the connection's implicit transaction
+        try:
+            self._connection.executescript(f"{migration.script}; pragma user_version = {version:d};")
+        except BaseException:
+            self._connection.rollback()
+            raise
         self._connection.commit()
+        self._backend.committed(self._connection)
+
+    async def _run_data_migrations(self, migrations: list[DataMigration]) -> None:
+        """
+        run the data migrations chunk by chunk.
+        each chunk is an ordinary write, so other writes are committed in between.
+        """
+        for migration in migrations:
+            logger.info("starting data migration %r...", migration.name)
+            start = time.monotonic()
+            total = 0
+            try:
+                while changed := await self.write(migration.sql, {"limit": migration.chunk_size}):
+                    total += changed
+
+                await self.write(
+                    "insert or replace into state(key, value) values (?, ?);",
+                    (f"data_migration:{migration.name}", "done"),
+                )
+            except sqlite3.Error:
+                logger.exception("data migration %r failed, it's retried at next startup", migration.name)
+                return
+
+            logger.info("data migration %r done: %d rows in %.01fs",
+                        migration.name, total, time.monotonic() - start)
@@ -0,0 +1,131 @@
+"""
+where the sqlite database of the bot lives.
+"""
+
+from __future__ import annotations
+
+import logging
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+# prepared statements kept per connection, KVStore alone has a dozen.
+STATEMENT_CACHE_SIZE = 256
+
+
+class StorageBackend(ABC):
+    """
+    creates the sqlite connections of a Database.
+    all methods are called in the database threads.
+    """
+
+    # whether connect_reader() is supported, needed for wal mode.
+    supports_readers: bool = False
+
+    @abstractmethod
+    def connect(self) -> sqlite3.Connection:
+        """
+        open the writer connection, in autocommit mode.
+        """
+
+    def connect_reader(self) -> sqlite3.Connection:
+        """
+        open a read-only connection, in autocommit mode.
+        """
+        raise NotImplementedError(f"{type(self).__name__} has no read-only connections")
+
+    def committed(self, connection: sqlite3.Connection) -> None:
+        """
+        called after each commit of the writer connection.
+        """
+
+    def close(self, connection: sqlite3.Connection) -> None:
+        """
+        called before the writer connection is closed.
+        """
+
+
+class FileBackend(StorageBackend):
+    """
+    database stored in a file.
+    """
+
+    supports_readers = True
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self._path, autocommit=True, cached_statements=STATEMENT_CACHE_SIZE)
+
+    def connect_reader(self) -> sqlite3.Connection:
+        # each select runs in its own implicit read transaction.
+        return sqlite3.connect(f"{self._path.absolute().as_uri()}?mode=ro", uri=True,
+                               autocommit=True, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+
+
+class MemoryBackend(StorageBackend):
+    """
+    database kept in memory only, without any disk io.
+
+    with a snapshot_path, the database is loaded from that file at startup,
+    and written back to it at shutdown and after commits,
+    at most every snapshot_interval seconds.
+    changes since the last snapshot are lost if the bot crashes.
+    """
+
+    def __init__(self, snapshot_path: Path | None = None, snapshot_interval: float | None = None):
+        self._snapshot_path = snapshot_path
+        self._snapshot_interval = snapshot_interval
+        self._last_snapshot = time.monotonic()
+        self._dirty = False
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(":memory:", autocommit=True, cached_statements=STATEMENT_CACHE_SIZE)
+        if self._snapshot_path is not None and self._snapshot_path.exists():
+            logger.info("loading database snapshot %s", self._snapshot_path)
+            snapshot = sqlite3.connect(self._snapshot_path)
+            try:
+                snapshot.backup(connection)
+            finally:
+                snapshot.close()
+        return connection
+
+    def committed(self, connection: sqlite3.Connection) -> None:
+        self._dirty = True
+        if (self._snapshot_interval is not None
+                and time.monotonic() - self._last_snapshot >= self._snapshot_interval):
+            self.snapshot(connection)
+
+    def close(self, connection: sqlite3.Connection) -> None:
+        if self._dirty:
+            self.snapshot(connection)
+
+    def snapshot(self, connection: sqlite3.Connection) -> None:
+        """
+        write the database to the snapshot file.
+        """
+        if self._snapshot_path is None:
+            return
+
+        start = time.monotonic()
+        # replace the old snapshot only once the new one is complete
+        tmp_path = self._snapshot_path.with_name(f"{self._snapshot_path.name}.tmp")
+        target = sqlite3.connect(tmp_path)
+        try:
+            connection.backup(target)
+        finally:
+            target.close()
+        tmp_path.replace(self._snapshot_path)
+
+        self._last_snapshot = time.monotonic()
+        self._dirty = False
+        logger.debug("wrote database snapshot in %.01fms", (self._last_snapshot - start) * 1000)
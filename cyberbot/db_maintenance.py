@@ -0,0 +1,129 @@
+"""
+database housekeeping tasks, run by the maintenance service.
+"""
+
+from __future__ import annotations
+
+import enum
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class MaintenanceTask(enum.Enum):
+    # refresh the statistics of the query planner
+    analyze = "analyze"
+    optimize = "optimize"
+    # give free pages back to the filesystem
+    incremental_vacuum = "incremental_vacuum"
+    # move the write-ahead-log into the database and truncate it
+    wal_checkpoint = "wal_checkpoint"
+
+
+@dataclass
+class MaintenanceResult:
+    task: MaintenanceTask
+    # seconds
+    duration: float
+    # bytes given back to the filesystem
+    reclaimed: int
+    # whether the time limit was hit
+    interrupted: bool
+
+
+# virtual machine instructions between time limit checks
+_PROGRESS_STEPS = 1000
+
+# pages freed per incremental vacuum step
+_VACUUM_STEP_PAGES = 256
+
+# wal frame header size, in addition to the page
+_WAL_FRAME_HEADER = 24
+
+
+def _pragma(connection: sqlite3.Connection, name: str) -> int:
+    return connection.execute(f"pragma {name};").fetchone()[0]
+
+
+def _incremental_vacuum(connection: sqlite3.Connection, timed_out: Callable[[], bool]) -> None:
+    # one transaction, so not every step syncs the database
+    connection.execute("begin immediate;")
+    try:
+        while _pragma(connection, "freelist_count") > 0 and not timed_out():
+            # each step of the statement frees one page, so run it to the end
+            connection.execute(f"pragma incremental_vacuum({_VACUUM_STEP_PAGES:d});").fetchall()
+    finally:
+        # keep the pages freed before an interruption
+        connection.set_progress_handler(None, 0)
+        if connection.in_transaction:
+            connection.execute("commit;")
+
+
+def run_task(connection: sqlite3.Connection, task: MaintenanceTask, time_limit: float,
+             wal: bool) -> MaintenanceResult:
+    """
+    run one maintenance task on the writer connection, which must be in autocommit mode.
+    the task is interrupted after time_limit seconds.
+    """
+    start = time.monotonic()
+    deadline = start + time_limit
+
+    def timed_out() -> bool:
+        return time.monotonic() > deadline
+
+    connection.set_progress_handler(timed_out, _PROGRESS_STEPS)
+
+    page_size = _pragma(connection, "page_size")
+    reclaimed = 0
+    interrupted = False
+    try:
+        match task:
+            case MaintenanceTask.analyze:
+                # only sample the tables, a full scan isn't needed for good plans
+                connection.execute("pragma analysis_limit = 1000;")
+                connection.execute("analyze;")
+
+            case MaintenanceTask.optimize:
+                connection.execute("pragma optimize;")
+
+            case MaintenanceTask.incremental_vacuum:
+                if _pragma(connection, "auto_vacuum") != 2:
+                    # switching needs a full vacuum, which can't be done within the time limit
+                    # of big databases, and blocks the bot meanwhile.
+                    logger.info("skipping incremental vacuum, the database isn't in incremental "
+                                "auto_vacuum mode. to convert it, run offline: "
+                                "sqlite3 <database> 'pragma auto_vacuum = incremental; vacuum;'")
+                else:
+                    pages = _pragma(connection, "page_count")
+                    try:
+                        _incremental_vacuum(connection, timed_out)
+                    finally:
+                        reclaimed = (pages - _pragma(connection, "page_count")) * page_size
+
+            case MaintenanceTask.wal_checkpoint:
+                if wal:
+                    # a truncating checkpoint reports no frames, so get the wal size first
+                    _busy, wal_frames, _checkpointed = connection.execute(
+                        "pragma wal_checkpoint(passive);"
+                    ).fetchone()
+                    busy, _, _ = connection.execute("pragma wal_checkpoint(truncate);").fetchone()
+                    if not busy:
+                        reclaimed = max(wal_frames, 0) * (page_size + _WAL_FRAME_HEADER)
+
+    except sqlite3.OperationalError as exc:
+        if exc.sqlite_errorname != "SQLITE_INTERRUPT":
+            raise
+        interrupted = True
+
+    finally:
+        connection.set_progress_handler(None, 0)
+
+    interrupted = interrupted or timed_out()
+    return MaintenanceResult(task, time.monotonic() - start, reclaimed, interrupted)
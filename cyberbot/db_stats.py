@@ -0,0 +1,119 @@
+"""
+timing statistics for database statements.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+# where a statement was issued: (filename, lineno, function)
+type Caller = tuple[str, int, str]
+
+
+# histogram bucket i counts durations below 2**i microseconds
+_BUCKETS = 40
+
+
+@dataclass
+class StatementSummary:
+    sql: str
+    count: int
+    # seconds
+    total: float
+    p50: float
+    p99: float
+
+
+class _StatementStats:
+    """
+    duration histogram of one normalized statement.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * _BUCKETS
+
+    def add(self, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        self.buckets[min(int(duration * 1e6).bit_length(), _BUCKETS - 1)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """
+        upper bound of the bucket containing the given fraction of durations, in seconds.
+        """
+        needed = fraction * self.count
+        seen = 0
+        for idx, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= needed:
+                return (1 << idx) / 1e6
+        return (1 << (_BUCKETS - 1)) / 1e6
+
+
+class StatementStats:
+    """
+    collects durations of executed sql statements, grouped by normalized sql text.
+    statements slower than slow_threshold seconds are logged with their caller.
+
+    record() is called from the database threads.
+    """
+
+    def __init__(self, slow_threshold: float | None = None) -> None:
+        self._slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._stats: dict[str, _StatementStats] = dict()
+        # raw sql -> normalized sql
+        self._normalized: dict[str, str] = dict()
+
+    def _normalize(self, sql: str) -> str:
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            normalized = " ".join(sql.split()).rstrip(";")
+            self._normalized[sql] = normalized
+        return normalized
+
+    def record(self, sql: str, duration: float, caller: Caller | None = None) -> None:
+        with self._lock:
+            normalized = self._normalize(sql)
+            stats = self._stats.get(normalized)
+            if stats is None:
+                stats = _StatementStats()
+                self._stats[normalized] = stats
+            stats.add(duration)
+
+        if self._slow_threshold is not None and duration >= self._slow_threshold:
+            if caller:
+                filename, lineno, function = caller
+                where = f"{filename}:{lineno} in {function}"
+            else:
+                where = "unknown caller"
+            logger.warning("slow sql statement took %.1fms: %s (from %s)", duration * 1000, normalized, where)
+
+    def summary(self) -> list[StatementSummary]:
+        """
+        statement statistics, the ones with the most total time first.
+        """
+        with self._lock:
+            ret = [
+                StatementSummary(
+                    sql=sql,
+                    count=stats.count,
+                    total=stats.total,
+                    p50=stats.percentile(0.5),
+                    p99=stats.percentile(0.99),
+                )
+                for sql, stats in self._stats.items()
+            ]
+        ret.sort(key=lambda entry: entry.total, reverse=True)
+        return ret
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
@@ -0,0 +1,181 @@
+"""
+database schema versions.
+
+the schema version is stored in sqlite's `PRAGMA user_version`,
+it's the number of applied entries in MIGRATIONS.
+never change an existing migration, always append a new one.
+"""
+
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    schema change, applied in one transaction at startup.
+    """
+    description: str
+    script: str
+
+
+@dataclass(frozen=True)
+class DataMigration:
+    """
+    a long-running data conversion, done in chunks in the background after startup.
+
+    `sql` is executed repeatedly until it no longer changes any rows.
+    it must only process the next :limit rows that still need conversion, e.g.
+    `update t set x = ... where rowid in (select rowid from t where x is null limit :limit);`
+
+    schema changes the data migration depends on have to be done in a Migration.
+    """
+    name: str
+    sql: str
+    chunk_size: int = 1000
+
+
+# bytes of a key-value entry, for storage usage accounting
+_ENTRY_SIZE = "(length(cast({row}.key as blob)) + coalesce(length(cast({row}.value as blob)), 0))"
+
+
+def _storage_usage_triggers(table: str, room: str, plugin: str) -> str:
+    """
+    triggers to keep storage_usage up to date for one key-value table.
+    room and plugin are the id column expressions of a row `{row}`.
+    """
+    def ids(row: str) -> str:
+        return f"{room.format(row=row)}, {plugin.format(row=row)}"
+
+    def where(row: str) -> str:
+        return f"roomid = {room.format(row=row)} and pluginname = {plugin.format(row=row)}"
+
+    def add(row: str) -> str:
+        return (f"insert into storage_usage(roomid, pluginname, keys, bytes) "
+                f"values ({ids(row)}, 1, {_ENTRY_SIZE.format(row=row)}) "
+                f"on conflict (roomid, pluginname) do update "
+                f"set keys = keys + 1, bytes = bytes + excluded.bytes;")
+
+    def remove(row: str) -> str:
+        return (f"update storage_usage set keys = keys - 1, bytes = bytes - {_ENTRY_SIZE.format(row=row)} "
+                f"where {where(row)};")
+
+    return f"""
+        create trigger {table}_usage_insert after insert on {table} begin
+            {add("new")}
+        end;
+        create trigger {table}_usage_delete after delete on {table} begin
+            {remove("old")}
+        end;
+        create trigger {table}_usage_update after update on {table} begin
+            {remove("old")}
+            {add("new")}
+        end;
+    """
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(
+        "initial schema",
+        # `if not exists`: databases from before the schema versioning have these tables already.
+        """
+        -- room_plugins: which plugins are activated in which room
+        create table if not exists room_plugins (
+            roomid     text,
+            pluginname text,
+            primary key (roomid, pluginname)
+        ) strict;
+
+        -- global room data
+        create table if not exists room_data (
+            roomid     text,
+            key        text,
+            value      text,
+            primary key (roomid, key)
+        ) strict;
+
+        -- plugin_data: global plugin data
+        create table if not exists plugin_data (
+            pluginname text,
+            key        text,
+            value      text,
+            primary key (pluginname, key)
+        ) strict;
+
+        -- data local to a plugin x room combination
+        create table if not exists room_plugin_data (
+            roomid     text,
+            pluginname text,
+            key        text,
+            value      text,
+            primary key (roomid, pluginname, key)
+        ) strict;
+
+        -- global bot information such as login token
+        create table if not exists state (
+            key   text primary key,
+            value text
+        ) strict;
+
+        -- mapping of interaction rooms and its config rooms
+        create table if not exists config_room (
+            source_roomid text,
+            target_roomid text
+        ) strict;
+        create index if not exists idx_config_rooms_source_roomid on config_room(source_roomid);
+        create index if not exists idx_config_rooms_target_roomid on config_room(target_roomid);
+        create unique index if not exists uidx_config_rooms_source_target_roomid
+            on config_room(source_roomid, target_roomid);
+
+        -- who may configure which room
+        create table if not exists config_acl (
+            roomid text primary key,
+            acl text
+        ) strict;
+        """,
+    ),
+    Migration(
+        "storage usage accounting",
+        # rooms and plugins are '' for room_data and plugin_data entries.
+        # replaced rows are accounted by the delete triggers,
+        # since the connections enable recursive_triggers.
+        f"""
+        create table storage_usage (
+            roomid     text not null,
+            pluginname text not null,
+            keys       integer not null,
+            bytes      integer not null,
+            primary key (roomid, pluginname)
+        ) strict;
+
+        insert into storage_usage(roomid, pluginname, keys, bytes)
+            select roomid, pluginname, count(*), sum({_ENTRY_SIZE.format(row="room_plugin_data")})
+            from room_plugin_data group by roomid, pluginname
+            union all
+            select roomid, '', count(*), sum({_ENTRY_SIZE.format(row="room_data")})
+            from room_data group by roomid
+            union all
+            select '', pluginname, count(*), sum({_ENTRY_SIZE.format(row="plugin_data")})
+            from plugin_data group by pluginname;
+
+        {_storage_usage_triggers("room_plugin_data", "{row}.roomid", "{row}.pluginname")}
+        {_storage_usage_triggers("room_data", "{row}.roomid", "''")}
+        {_storage_usage_triggers("plugin_data", "''", "{row}.pluginname")}
+        """,
+    ),
+    Migration(
+        "key expiry",
+        # unix timestamp after which the entry is gone, null for no expiry
+        """
+        alter table room_plugin_data add column expires real;
+        alter table room_data add column expires real;
+        alter table plugin_data add column expires real;
+        create index idx_room_plugin_data_expires on room_plugin_data(expires) where expires is not null;
+        create index idx_room_data_expires on room_data(expires) where expires is not null;
+        create index idx_plugin_data_expires on plugin_data(expires) where expires is not null;
+        """,
+    ),
+]
+
+
+DATA_MIGRATIONS: list[DataMigration] = [
+]
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import textwrap
+from argparse import ArgumentTypeError
 from dataclasses import dataclass
 from typing import TYPE_CHECKING
 
@@ -18,6 +20,19 @@ if TYPE_CHECKING:
 roles: list[str] = [val.value for val in Role] + ["none"]
 
 
+def _positive_int(value: str) -> int:
+    """
+    argparse type for counts of at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"not a number: {value!r}") from None
+    if number < 1:
+        raise ArgumentTypeError(f"must be at least 1: {value!r}")
+    return number
+
+
 @dataclass
 class Issuer:
     """
@@ -154,6 +169,21 @@ class Config(RoomPlugin):
         list_cli = plugin_sp.add_parser("list")
         list_cli.add_argument("--all", action="store_true")
 
+        #- stats (bot admins only)
+        stats_cli = sp.add_parser("stats")
+        stats_sp = stats_cli.add_subparsers(dest="stats_action", required=True)
+
+        #-- stats db [--top N]: slowest database statements
+        stats_db_cli = stats_sp.add_parser("db")
+        stats_db_cli.add_argument("--top", type=_positive_int, default=10)
+
+        #-- stats storage [--top N]: biggest storage consumers
+        stats_storage_cli = stats_sp.add_parser("storage")
+        stats_storage_cli.add_argument("--top", type=_positive_int, default=10)
+
+        #-- stats power-levels: where user power levels came from
+        _stats_power_levels_cli = stats_sp.add_parser("power-levels")
+
         #--- room plugin config <plugin_name> <what>
         if target_room is not None:
             configurable_plugins: dict[str, RoomPlugin] = target_room.get_plugins()
@@ -227,9 +257,54 @@ class Config(RoomPlugin):
             case "room":
                 await self._cmd_room(issuer, args, parser)
 
+            case "stats":
+                await self._cmd_stats(issuer, args)
+
             case _:
                 raise NotImplementedError(f"unknown cmd mode {args.mode!r}")
 
+    async def _cmd_stats(self, issuer: Issuer, args: Namespace) -> None:
+        """
+        bot runtime statistics, for bot admins.
+        """
+        if not self._api.is_bot_admin(issuer.user_id):
+            await self._send_notice("only bot admins can view statistics")
+            return
+
+        match args.stats_action:
+            case "db":
+                statements = self._api.get_db_stats()[:args.top]
+                if not statements:
+                    await self._send_notice("no database statements recorded yet")
+                    return
+
+                lines = [f"{'count':>8} {'total ms':>10} {'p50 ms':>8} {'p99 ms':>8}  statement"]
+                for stmt in statements:
+                    lines.append(f"{stmt.count:>8} {stmt.total * 1000:>10.1f} {stmt.p50 * 1000:>8.2f} "
+                                 f"{stmt.p99 * 1000:>8.2f}  {textwrap.shorten(stmt.sql, width=100)}")
+                await self._send_block("\n".join(lines))
+
+            case "storage":
+                usages = await self._api.get_storage_usage(args.top)
+                if not usages:
+                    await self._send_notice("no data stored yet")
+                    return
+
+                entries, hits, misses = self._api.get_kv_cache_stats()
+                lines = [f"cache: {entries} entries, {hits} hits, {misses} misses", "",
+                         f"{'KiB':>10} {'keys':>8}  {'plugin':<20} room"]
+                for usage in usages:
+                    lines.append(f"{usage.bytes / 1024:>10.1f} {usage.keys:>8}  "
+                                 f"{usage.plugin_name or '(room data)':<20} {usage.room_id or '(all rooms)'}")
+                await self._send_block("\n".join(lines))
+
+            case "power-levels":
+                hits, misses = self._api.get_power_level_stats()
+                await self._send_notice(f"power levels: {hits} from room state, {misses} fetched from homeserver")
+
+            case _:
+                raise NotImplementedError()
+
     async def _cmd_room(self, issuer: Issuer, args: Namespace, parser: CommandParser) -> None:
         """
         commands to select, configure, create, change rooms.
@@ -237,7 +312,7 @@ class Config(RoomPlugin):
 
         match args.room_action:
             case "list":
-                rooms = await self._api.get_config_target_rooms()
+                rooms = self._api.get_configurable_rooms(issuer.user_id, issuer.power_level)
                 if rooms:
                     lines = ["configurable rooms:"]
                     maxroom = max(len(name) for name in rooms.keys())
@@ -270,7 +345,7 @@ class Config(RoomPlugin):
                     await self._send_notice("no room selected to operate on")
                     return
 
-                with target_room.acl as acl:
+                async with target_room.acl as acl:
                     if not acl.user_has_role(Role.config, user_id=issuer.user_id, user_level=issuer.power_level):
                         await self._send_notice("you're not allowed to configure this room")
                         return
@@ -287,11 +362,11 @@ class Config(RoomPlugin):
                     case "acl":
                         match args.acl_action:
                             case "show":
-                                with target_room.acl as acl:
+                                async with target_room.acl as acl:
                                     await self._send_block(acl.show())
 
                             case "set-role":
-                                with target_room.acl as acl:
+                                async with target_room.acl as acl:
                                     if args.role == "none":
                                         acl.user_roles_clear(args.username)
                                     else:
@@ -302,11 +377,11 @@ class Config(RoomPlugin):
                                     await self._send_notice(f"role {args.role!r} must be set, not removed.")
                                     return
 
-                                with target_room.acl as acl:
+                                async with target_room.acl as acl:
                                     acl.user_role_remove(args.username, args.role)
 
                             case "set-level-role":
-                                with target_room.acl as acl:
+                                async with target_room.acl as acl:
                                     if args.role == "none":
                                         acl.level_roles_clear(args.level)
                                     else:
@@ -317,7 +392,7 @@ class Config(RoomPlugin):
                                     await self._send_notice(f"role {args.role!r} must be set, not removed.")
                                     return
 
-                                with target_room.acl as acl:
+                                async with target_room.acl as acl:
                                     acl.level_role_remove(args.level, args.role)
 
                             case _:
@@ -351,7 +426,7 @@ class Config(RoomPlugin):
             await self._send_notice("no room selected to operate on")
             return
 
-        with target_room.acl as acl:
+        async with target_room.acl as acl:
             if not acl.user_has_role(Role.config,
                                      user_id=issuer.user_id,
                                      user_level=issuer.power_level):
@@ -409,7 +484,7 @@ class Config(RoomPlugin):
         """
         target_room = self._api.get_room(room_id)
         if target_room:
-            with target_room.acl as acl:
+            async with target_room.acl as acl:
                 if not acl.user_has_role(Role.config, user_id=issuer.user_id, user_level=issuer.power_level):
                     await self._send_notice("you're not allowed to configure this room")
                     return
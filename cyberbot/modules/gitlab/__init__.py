@@ -13,6 +13,9 @@ if typing.TYPE_CHECKING:
 
 
 class GitLab(RoomPlugin):
+    # webhooks and config are read at init and for each hook event
+    preload_storage = True
+
     def __init__(self, api: RoomAPI):
         self._handler = GitHookHandler(
             api,
@@ -475,3 +475,12 @@ class GitLabFormatter(GitFormatter):
             "emoji": True,
             "notice": True,
         }
+
+    def update_key(self, event: str, content: Any) -> tuple[str, str] | None:
+        # one message per pipeline, with the pipeline status and the status of each job
+        match event:
+            case "Pipeline Hook":
+                return f"pipeline {content['object_attributes']['id']}", "pipeline"
+            case "Job Hook":
+                return f"pipeline {content['pipeline_id']}", f"job {content['build_id']}"
+        return None
@@ -56,6 +56,14 @@ class GitFormatter(ABC):
         """
         pass
 
+    def update_key(self, event: str, content: Any) -> tuple[str, str] | None:
+        """
+        events about the same thing can update one message instead of sending new ones.
+        return (message key, part key): the message shows the latest text of each of its parts.
+        None sends a new message.
+        """
+        return None
+
 
 class GitEventFormatter(ABC):
     def __init__(self, emojis: bool, main_emoji: str | None) -> None:
@@ -1,11 +1,14 @@
 from __future__ import annotations
 
-import json
+import asyncio
 import random
 import string
 import textwrap
+import time
 import typing
 from argparse import ArgumentParser, Namespace
+from collections import OrderedDict
+from dataclasses import dataclass, field
 
 from pydantic import BaseModel
 
@@ -26,6 +29,26 @@ class _WebHook(BaseModel):
     description: str
 
 
+# messages which are still updated, the oldest are sent as new messages again
+_LIVE_MESSAGES_MAX = 64
+# seconds after the last update until a message is no longer updated
+_LIVE_MESSAGE_TTL = 6 * 60 * 60.0
+
+
+@dataclass
+class _LiveMessage:
+    """
+    a sent message which is edited by later events.
+    """
+    event_id: str
+    expires: float
+    # part key -> latest html of the part
+    parts: dict[str, str] = field(default_factory=dict)
+
+    def html(self) -> str:
+        return "<br/>".join(self.parts.values())
+
+
 # TODO: this is pretty duplicated with hookmsg.HookMsg -> unify!
 class GitHookHandler(BaseGitHookHandler):
     """
@@ -61,6 +84,11 @@ class GitHookHandler(BaseGitHookHandler):
         self._info_url = info_url
         self._new_hook_message = new_hook_message
 
+        # message key -> live message, least recently updated first
+        self._live_messages: OrderedDict[str, _LiveMessage] = OrderedDict()
+        # so concurrent events about one thing don't send several messages
+        self._live_lock = asyncio.Lock()
+
     def config_setup(self, parser: ArgumentParser) -> PluginConfigParser | None:
         sp = parser.add_subparsers(dest=f"{self._git_variant}_action", required=True)
 
@@ -153,14 +181,12 @@ class GitHookHandler(BaseGitHookHandler):
         """
         restore available tokens from storage.
         """
-        if hooks_raw := await self._api.storage.get(self._store_key_hook):
-            for hook_raw in json.loads(hooks_raw):
-                hook = _WebHook(**hook_raw)
+        if hooks := await self._api.storage.get_json(self._store_key_hook, list[_WebHook]):
+            for hook in hooks:
                 self._add_hook(hook)
 
     async def _store_hooks(self) -> None:
-        hook_data = json.dumps([hook.model_dump() for hook in self._webhooks.values()])
-        await self._api.storage.set(self._store_key_hook, hook_data)
+        await self._api.storage.set_json(self._store_key_hook, list(self._webhooks.values()))
 
     async def _cfg_hook_rm(self, config_api: RoomAPI, hook_id: str) -> None:
         hook = self._webhooks.pop(hook_id, None)
@@ -212,13 +238,13 @@ class GitHookHandler(BaseGitHookHandler):
             return
 
         config[key] = value.lower() == "true"
-        await self._api.storage.set("config", json.dumps(config))
+        await self._api.storage.set_json("config", config)
         await self._api.send_text(f"set {key!r} to {config[key]}")
 
     async def _get_config(self) -> dict[str, bool]:
-        custom_config_raw = (await self._api.storage.get("config")) or "{}"
-        custom_config = json.loads(custom_config_raw)
+        custom_config = await self._api.storage.get_json("config", dict[str, bool]) or {}
 
+        # a new dict, the cached custom config isn't modified
         config = self._formatter.get_config() | custom_config
         return config
 
@@ -234,5 +260,33 @@ class GitHookHandler(BaseGitHookHandler):
             content,
             config,
         )
-        if text is not None:
+        if text is None:
+            return
+
+        if update_key := self._formatter.update_key(event, content):
+            await self._update_live_message(*update_key, text, notice=config["notice"])
+        else:
             await self._api.send_html(text, notice=config["notice"])
+
+    async def _update_live_message(self, message_key: str, part_key: str, text: str, notice: bool) -> None:
+        """
+        set the part of the message, which is edited if it was sent recently, or sent anew.
+        """
+        async with self._live_lock:
+            now = time.monotonic()
+            live = self._live_messages.pop(message_key, None)
+
+            if live is not None and live.expires > now:
+                live.parts[part_key] = text
+                await self._api.edit_html(live.event_id, live.html(), notice=notice)
+
+            else:
+                event_id = await self._api.send_html(text, notice=notice, coalesce=False)
+                if event_id is None:
+                    return
+                live = _LiveMessage(event_id, now, {part_key: text})
+
+            live.expires = now + _LIVE_MESSAGE_TTL
+            self._live_messages[message_key] = live
+            while len(self._live_messages) > _LIVE_MESSAGES_MAX:
+                self._live_messages.popitem(last=False)
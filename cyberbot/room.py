@@ -4,6 +4,7 @@ import enum
 import io
 import logging
 import os
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import TYPE_CHECKING, Any
 
@@ -12,12 +13,14 @@ import nio
 
 from .room_acl import RoomACL
 from .room_module import RoomModule
+from .send_scheduler import SendError
 from .types import Err, Ok, Result
 from .util import run_tasks
 
 if TYPE_CHECKING:
     from .api.room_plugin import RoomPlugin
     from .bot import Bot, RoomMessageText
+    from .database import Database
 
 
 class RoomMode(enum.IntFlag):
@@ -44,6 +47,52 @@ class RoomHistoryVisibility(enum.Enum):
     invite = enum.auto()
 
 
+@dataclass
+class RoomState:
+    """
+    stored state of a room, what Room.setup needs from the database.
+    """
+
+    # None if the room is new to us
+    room_mode: RoomMode | None = None
+    # enabled plugin names
+    plugins: list[str] = field(default_factory=list)
+    # rooms this room configures
+    config_targets: set[str] = field(default_factory=set)
+    # rooms which configure this room
+    config_sources: set[str] = field(default_factory=set)
+    # the stored acl text
+    acl: str | None = None
+
+
+async def load_room_states(db: Database) -> dict[str, RoomState]:
+    """
+    read the state of all rooms at once, with one query per table.
+    rooms without any stored state are missing in the result.
+    """
+    states: dict[str, RoomState] = dict()
+
+    def state(room_id: str) -> RoomState:
+        if (room_state := states.get(room_id)) is None:
+            room_state = states[room_id] = RoomState()
+        return room_state
+
+    for room_id, value in await db.read("select roomid, value from room_data where key='room_mode';"):
+        state(room_id).room_mode = RoomMode(int(value))
+
+    for room_id, plugin_name in await db.read("select roomid, pluginname from room_plugins;"):
+        state(room_id).plugins.append(plugin_name)
+
+    for source_id, target_id in await db.read("select source_roomid, target_roomid from config_room;"):
+        state(source_id).config_targets.add(target_id)
+        state(target_id).config_sources.add(source_id)
+
+    for room_id, acl in await db.read("select roomid, acl from config_acl;"):
+        state(room_id).acl = acl
+
+    return states
+
+
 class Room:
     def __init__(self, bot: Bot, nio_room: nio.MatrixRoom):
         self.room_id = nio_room.room_id
@@ -54,15 +103,22 @@ class Room:
         self._log = logging.getLogger(f"{__name__}.{self.room_id}")
 
         self._acl = RoomACL(bot, self.room_id)
+        # known once set up
+        self.mode: RoomMode | None = None
+
+        # whether nio has processed a m.room.power_levels event of this room
+        self._power_levels_synced = False
+        # m.room.power_levels content fetched from the homeserver, when nio had none
+        self._fetched_power_levels: dict[str, Any] | None = None
 
     def __str__(self):
         return f"Matrix Room {self.room_id}{' encrypted' if self._nio_room.encrypted else ''}"
 
-    def get_room_mode(self) -> RoomMode | None:
-        room_mode_row = self._bot.db.read(
+    async def get_room_mode(self) -> RoomMode | None:
+        room_mode_row = await self._bot.db.read_one(
             "select value from room_data where roomid=? and key=?",
             (self.room_id, "room_mode"),
-        ).fetchone()
+        )
 
         if room_mode_row is None:
             return None
@@ -73,9 +129,11 @@ class Room:
         self,
         invited_by: str | None = None,
         config_room_for: str | None = None,
+        state: RoomState | None = None,
     ) -> bool:
         """
         when the room is created upon initial join or bot restart.
+        state is the stored room state, if it was already loaded. otherwise it's queried.
 
         for each managed room, link to its config room(s):
 
@@ -85,8 +143,11 @@ class Room:
         returns if initialization succeeded
         """
 
+        state = state or await self._query_state()
+        self._acl.preload(state.acl)
+
         # do we know this room already?
-        room_mode = self.get_room_mode()
+        room_mode = state.room_mode
 
         if room_mode is None:
             room_mode, ok = await self._setup_new(
@@ -100,9 +161,11 @@ class Room:
             self._log.warning("skipping initialization of disabled room")
             return False
 
+        self.mode = room_mode
+
         # this room can be used to configure another room
         if RoomMode.CONFIG in room_mode:
-            configured_rooms = await self.config_target_rooms()
+            configured_rooms = state.config_targets
 
             # cleanup rooms we're no longer in
             obsolete_tgt_rooms: set[str] = set()
@@ -112,8 +175,8 @@ class Room:
 
             if obsolete_tgt_rooms:
                 self._log.info("removing config target rooms: %s", obsolete_tgt_rooms)
-                self._bot.db.write_many("delete from config_room where source_roomid=? and target_roomid=?;",
-                                        paramlist=((self.room_id, obsolete) for obsolete in obsolete_tgt_rooms))
+                await self._bot.db.write_many("delete from config_room where source_roomid=? and target_roomid=?;",
+                                              paramlist=((self.room_id, obsolete) for obsolete in obsolete_tgt_rooms))
 
             ok = await self._load_plugin("config")
             if not ok:
@@ -123,7 +186,7 @@ class Room:
         # this room can be configured by a config room and has interaction plugins
         if RoomMode.INTERACTION in room_mode:
             # which room can configure this room?
-            config_rooms = await self.config_source_rooms()
+            config_rooms = state.config_sources
 
             # cleanup config rooms we're no longer in
             obsolete_src_rooms: set[str] = set()
@@ -133,15 +196,31 @@ class Room:
 
             if obsolete_src_rooms:
                 self._log.info("removing config source rooms: %s", obsolete_src_rooms)
-                self._bot.db.write_many("delete from config_room where source_roomid=? and target_roomid=?;",
-                                        paramlist=((obsolete, self.room_id) for obsolete in obsolete_src_rooms))
+                await self._bot.db.write_many("delete from config_room where source_roomid=? and target_roomid=?;",
+                                              paramlist=((obsolete, self.room_id) for obsolete in obsolete_src_rooms))
 
             # load configured plugins for the room
             # assume it's ok if they fail, recovery should be done from the config room then.
-            await self._load_plugins()
+            await self._load_plugins(state.plugins)
 
         return True
 
+    async def _query_state(self) -> RoomState:
+        """
+        read the stored state of just this room.
+        """
+        db = self._bot.db
+        plugin_rows = await db.read("select pluginname from room_plugins where roomid = ?;", (self.room_id,))
+        acl_row = await db.read_one("select acl from config_acl where roomid=?;", (self.room_id,))
+
+        return RoomState(
+            room_mode=await self.get_room_mode(),
+            plugins=[pname for (pname,) in plugin_rows],
+            config_targets=await self.config_target_rooms(),
+            config_sources=await self.config_source_rooms(),
+            acl=acl_row[0] if acl_row else None,
+        )
+
     async def init(self) -> None:
         for plugin in self._modules.values():
             await plugin.init()
@@ -188,10 +267,11 @@ class Room:
                                                   f'by invite from {invited_by}'), notice=True)
 
         # record discovered room mode
-        self._bot.db.write(
+        await self._bot.db.write(
             "insert or replace into room_data(roomid, key, value) values(?, ?, ?);",
             (self.room_id, "room_mode", room_mode),
         )
+        self._bot.kv_cache.invalidate(("room_data", self.room_id, "room_mode"))
 
         return room_mode, True
 
@@ -204,14 +284,9 @@ class Room:
 
         return ok
 
-    async def _load_plugins(self):
+    async def _load_plugins(self, plugin_names: list[str]):
         self._log.info("Loading enabled room plugins...")
-        rows = self._bot.db.write(
-            "select pluginname from room_plugins where roomid = ?;",
-            (self.room_id,),
-        )
-
-        for (pname,) in rows.fetchall():
+        for pname in plugin_names:
             ok = await self._load_plugin(pname)
             if isinstance(ok, Err):
                 self._log.error(f"failed to load plugin {pname}")
@@ -229,7 +304,7 @@ class Room:
         ok = await self._load_plugin(pluginname)
         if ok:
             await self._modules[pluginname].init()
-            self._bot.db.write(
+            await self._bot.db.write(
                 """
                 insert into room_plugins(roomid, pluginname)
                 values (?,?);
@@ -245,7 +320,7 @@ class Room:
         self._log.info(f"Removing plugin {pluginname} from room...")
 
         # make sure the plugin won't load at next bot startup
-        self._bot.db.write(
+        await self._bot.db.write(
             """
             delete from room_plugins
             where roomid=? and pluginname=?;
@@ -310,19 +385,56 @@ class Room:
         ], timeout=20)
 
     ### functions for adding room content
-    async def send_message(
-        self, content: dict[Any, Any]
-    ) -> nio.RoomSendResponse | nio.RoomSendError:
-        return await self._bot.mxclient.room_send(
-            room_id=self.room_id,
-            message_type="m.room.message",
+    async def send_message(self, content: dict[Any, Any], coalesce: bool = False) -> str | None:
+        """
+        send a message to the room, after the messages sent before.
+        with coalesce, it may be merged with other messages sent at about the same time.
+        returns the event id, or None if it could not be sent.
+        """
+        try:
+            return await self._bot.send_scheduler.send(self.room_id, content, coalesce=coalesce)
+        except SendError as exc:
+            self._log.error("%s", exc)
+            return None
+
+    async def send_text(
+        self, text: str | None = None, html: str | None = None, notice: bool = False, coalesce: bool = True
+    ):
+        """
+        coalesce: notices may be merged with others sent at about the same time.
+                  don't for messages that are edited later.
+        """
+        content = self._text_content(text, html, notice)
+
+        # bursts of notices are merged into fewer messages
+        return await self.send_message(
             content=content,
-            ignore_unverified_devices=True,
+            coalesce=notice and coalesce,
         )
 
-    async def send_text(
-        self, text: str | None = None, html: str | None = None, notice: bool = False
+    async def send_html(self, html: str, text: str = "", notice=False, coalesce: bool = True):
+        return await self.send_text(html=html, text=text, notice=notice, coalesce=coalesce)
+
+    async def edit_text(
+        self, event_id: str, text: str | None = None, html: str | None = None, notice: bool = False
     ):
+        """
+        replace the content of a message sent before.
+        """
+        new_content = self._text_content(text, html, notice)
+
+        # clients without edit support show the fallback
+        content: dict[str, Any] = {
+            key: f"* {value}" if key in ("body", "formatted_body") else value
+            for key, value in new_content.items()
+        }
+        content["m.new_content"] = new_content
+        content["m.relates_to"] = {"rel_type": "m.replace", "event_id": event_id}
+
+        return await self.send_message(content=content)
+
+    @staticmethod
+    def _text_content(text: str | None, html: str | None, notice: bool) -> dict[str, str]:
         content: dict[str, str]
         if html is not None:
             content = {
@@ -339,12 +451,7 @@ class Room:
         else:
             raise ValueError("no message content given")
 
-        return await self.send_message(
-            content=content,
-        )
-
-    async def send_html(self, html: str, text: str = "", notice=False):
-        return await self.send_text(html=html, text=text, notice=notice)
+        return content
 
     async def send_image(self, handle: io.BytesIO, filename: str):
         iostart = handle.tell()
@@ -429,19 +536,39 @@ class Room:
         """
         return self._nio_room.user_name(user_id)
 
+    def on_power_levels_event(self) -> None:
+        """
+        nio has updated the room's power levels from a m.room.power_levels event.
+        """
+        self._power_levels_synced = True
+        self._fetched_power_levels = None
+
     async def get_user_power_level(self, user_id: str) -> int:
-        power_levels = await self._bot.mxclient.room_get_state_event(self.room_id, "m.room.power_levels")
-        if isinstance(power_levels, nio.RoomGetStateEventError):
-            raise ValueError(f"failed to fetch room power levels: {power_levels}")
+        tracker = self._bot.rooms
+
+        # nio keeps the power levels from the synced room state.
+        # they always list the room creator, so no users means we haven't seen the state yet.
+        power_levels = self._nio_room.power_levels
+        if self._power_levels_synced or power_levels.users:
+            tracker.power_level_hits += 1
+            return power_levels.get_user_level(user_id)
+
+        if self._fetched_power_levels is None:
+            tracker.power_level_misses += 1
+            response = await self._bot.mxclient.room_get_state_event(self.room_id, "m.room.power_levels")
+            if isinstance(response, nio.RoomGetStateEventError):
+                raise ValueError(f"failed to fetch room power levels: {response}")
+            self._fetched_power_levels = response.content
+        else:
+            tracker.power_level_hits += 1
 
+        content = self._fetched_power_levels
         user_power_level: int
         try:
-            user_power_level = power_levels.content["users"][user_id]
+            user_power_level = content["users"][user_id]
         except KeyError:
-            try:
-                user_power_level = power_levels.content["users_default"]
-            except KeyError as exc:
-                raise ValueError("couldn't get user power levels") from exc
+            # users_default is 0 if missing
+            user_power_level = content.get("users_default", 0)
 
         return user_power_level
 
@@ -4,8 +4,10 @@ access control lists for a room
 
 from __future__ import annotations
 
+import asyncio
 import enum
 import json
+from bisect import bisect_right, insort
 from contextlib import contextmanager
 from typing import TYPE_CHECKING
 
@@ -29,6 +31,8 @@ class _ACL:
         self.user: dict[str, set[str]] = dict()
         # {min_level -> {role, ...}}  # which room level may configure
         self.level: dict[int, set[str]] = dict()
+        # {role -> lowest level that has it}, built from self.level on demand
+        self._role_min_level: dict[str, int] | None = None
 
         if text is not None:
             try:
@@ -42,6 +46,12 @@ class _ACL:
             for min_level, privs in raw_entries["level"].items():
                 self.level[int(min_level)] = set(privs)
 
+    def copy(self) -> _ACL:
+        acl = _ACL(None)
+        acl.user = {user: set(privs) for user, privs in self.user.items()}
+        acl.level = {level: set(privs) for level, privs in self.level.items()}
+        return acl
+
     def dump(self):
         out = {
             "user": {user: list(privs) for user, privs in self.user.items()},
@@ -61,11 +71,23 @@ class _ACL:
     def level_role_add(self, min_level: int, role: Role):
         privs = self.level.setdefault(min_level, set())
         privs.add(role)
+        self._role_min_level = None
 
     def level_role_remove(self, min_level: int, role: Role):
         privs = self.level.get(min_level)
         if privs:
             privs.discard(role)
+        self._role_min_level = None
+
+    def _get_role_min_level(self) -> dict[str, int]:
+        if self._role_min_level is None:
+            role_min_level: dict[str, int] = dict()
+            for level_nr, level_privs in self.level.items():
+                for role in level_privs:
+                    if level_nr < role_min_level.get(role, level_nr + 1):
+                        role_min_level[role] = level_nr
+            self._role_min_level = role_min_level
+        return self._role_min_level
 
     def is_allowed(
         self, role: Role, user_id: str | None = None, level: int | None = None
@@ -80,11 +102,9 @@ class _ACL:
                 return True
 
         if level is not None:
-            for level_nr, level_privs in self.level.items():
-                # collect all privileges applicable for the current user
-                if level_nr <= level:
-                    if role in level_privs:
-                        return True
+            min_level = self._get_role_min_level().get(role)
+            if min_level is not None and min_level <= level:
+                return True
 
         return False
 
@@ -95,6 +115,11 @@ class _ACL:
 class RoomACL:
     """
     manage the acl of a room.
+
+    the stored acl is read once and kept in memory, all writes go through _commit.
+    changes are done on a copy, which replaces the cached acl when committed.
+
+    `async with room.acl` blocks of a room run one after another, so blocks can't be nested.
     """
 
     def __init__(self, bot: Bot, room_id: str):
@@ -102,33 +127,68 @@ class RoomACL:
         self._room_id: str = room_id
         self._changed: bool = False
         self._acl: _ACL | None = None
+        # the committed acl
+        self._cached: _ACL | None = None
+        # held during `async with`, the blocks await and share _acl and _changed
+        self._lock = asyncio.Lock()
 
-    def __enter__(self) -> RoomACL:
-        acl_raw = self._bot.db.read(
-            "select acl from config_acl where roomid=?", (self._room_id,)
-        ).fetchone()
-        if acl_raw:
-            acl_raw = acl_raw[0]
-        self._acl = _ACL(acl_raw)
+    async def __aenter__(self) -> RoomACL:
+        await self._lock.acquire()
+        try:
+            if self._cached is None:
+                acl_raw = await self._bot.db.read_one(
+                    "select acl from config_acl where roomid=?", (self._room_id,)
+                )
+                # unless a commit was done meanwhile
+                if self._cached is None:
+                    self.preload(acl_raw[0] if acl_raw else None)
+        except BaseException:
+            self._lock.release()
+            raise
+        self._acl = self._cached
         return self
 
-    def __exit__(self, type, exc_value, traceback):
-        if self._changed and exc_value is None:
-            # only commit if we changed something
-            # and there no exception
-            self._commit()
-        self._acl = None
+    async def __aexit__(self, type, exc_value, traceback):
+        try:
+            if self._changed and exc_value is None:
+                # only commit if we changed something
+                # and there no exception
+                await self._commit()
+        finally:
+            self._acl = None
+            self._changed = False
+            self._lock.release()
 
-    def _commit(self):
+    async def _commit(self):
         if self._acl is None:
-            raise RuntimeError("missing acl data due to missing 'with room.acl'")
+            raise RuntimeError("missing acl data due to missing 'async with room.acl'")
 
-        self._bot.db.write(
+        acl = self._acl
+        await self._bot.db.write(
             "insert or replace into config_acl(roomid, acl) values (?, ?);",
-            (self._room_id, self._acl.dump()),
+            (self._room_id, acl.dump()),
         )
+
+        def committed() -> None:
+            self._cached = acl
+            self._bot.rooms.config_index.update(self._room_id, acl)
+
+        if (txn := self._bot.db.current_transaction()) is not None:
+            # read it again until the transaction is committed
+            self._cached = None
+            txn.after_commit(committed)
+        else:
+            committed()
         self._acl = None
 
+    def preload(self, acl_raw: str | None) -> None:
+        """
+        use the stored acl text, e.g. when it was fetched for many rooms at once.
+        """
+        acl = _ACL(acl_raw)
+        self._cached = acl
+        self._bot.rooms.config_index.update(self._room_id, acl)
+
     @contextmanager
     def _get_acl(self, change: bool=False) -> Generator[_ACL]:
         """
@@ -136,7 +196,10 @@ class RoomACL:
         and set remember if it changed after adjustments.
         """
         if self._acl is None:
-            raise RuntimeError("acl has not been read from db yet - use 'with room.acl' statement")
+            raise RuntimeError("acl has not been read from db yet - use 'async with room.acl' statement")
+        if change and not self._changed:
+            # keep the cached acl unchanged until the commit
+            self._acl = self._acl.copy()
         try:
             yield self._acl
         finally:
@@ -169,7 +232,7 @@ class RoomACL:
     def user_role_remove(self, user_id: str, role_name: str):
         with self._get_acl(change=True) as acl:
             role: Role = Role(role_name)
-            acl.user_role_add(user_id, role)
+            acl.user_role_remove(user_id, role)
 
     def user_roles_clear(self, user_id: str):
         with self._get_acl(change=True) as acl:
@@ -179,7 +242,7 @@ class RoomACL:
     def level_role_add(self, level: int, role_name: str):
         with self._get_acl(change=True) as acl:
             role: Role = Role(role_name)
-            acl.level_role_remove(level, role)
+            acl.level_role_add(level, role)
 
     def level_role_remove(self, level: int, role_name: str):
         with self._get_acl(change=True) as acl:
@@ -190,3 +253,71 @@ class RoomACL:
         with self._get_acl(change=True) as acl:
             for role in Role:
                 acl.level_role_remove(level, role)
+
+
+class ConfigIndex:
+    """
+    which rooms can a user configure?
+
+    inverted index of the config role in the acls of all rooms,
+    kept up to date by RoomACL when an acl is loaded or committed,
+    and by the RoomTracker when the bot leaves a room.
+    """
+
+    def __init__(self) -> None:
+        # user_id -> {room_id, ...} where the user has the config role
+        self._user_rooms: dict[str, set[str]] = dict()
+        # room_id -> {user_id, ...}, the reverse of _user_rooms
+        self._room_users: dict[str, set[str]] = dict()
+        # min_level -> {room_id, ...} where this is the lowest level with the config role
+        self._level_rooms: dict[int, set[str]] = dict()
+        # room_id -> min_level
+        self._room_level: dict[str, int] = dict()
+        # sorted keys of _level_rooms
+        self._levels: list[int] = []
+
+    def update(self, room_id: str, acl: _ACL) -> None:
+        self.remove(room_id)
+
+        users = {user_id for user_id, privs in acl.user.items() if Role.config in privs}
+        if users:
+            self._room_users[room_id] = users
+            for user_id in users:
+                self._user_rooms.setdefault(user_id, set()).add(room_id)
+
+        min_level = acl._get_role_min_level().get(Role.config)
+        if min_level is not None:
+            self._room_level[room_id] = min_level
+            if min_level not in self._level_rooms:
+                self._level_rooms[min_level] = set()
+                insort(self._levels, min_level)
+            self._level_rooms[min_level].add(room_id)
+
+    def remove(self, room_id: str) -> None:
+        for user_id in self._room_users.pop(room_id, ()):
+            user_rooms = self._user_rooms[user_id]
+            user_rooms.discard(room_id)
+            if not user_rooms:
+                del self._user_rooms[user_id]
+
+        min_level = self._room_level.pop(room_id, None)
+        if min_level is not None:
+            level_rooms = self._level_rooms[min_level]
+            level_rooms.discard(room_id)
+            if not level_rooms:
+                del self._level_rooms[min_level]
+                self._levels.remove(min_level)
+
+    def rooms(self, user_id: str | None = None, level: int | None = None) -> set[str]:
+        """
+        the rooms where the user has the config role, either directly or with the given power level.
+        """
+        rooms: set[str] = set()
+        if user_id is not None:
+            rooms.update(self._user_rooms.get(user_id, ()))
+
+        if level is not None:
+            for min_level in self._levels[:bisect_right(self._levels, level)]:
+                rooms.update(self._level_rooms[min_level])
+
+        return rooms
@@ -40,6 +40,9 @@ class RoomModule:
         if self._plugin is None:
             raise Exception("called init on RoomModule without loaded RoomPlugin")
         try:
+            if self._plugin_cls.preload_storage:
+                await self._api.storage.preload()
+
             self._log.debug("initializing module...")
             await self._plugin.init()
 
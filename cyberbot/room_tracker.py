@@ -1,15 +1,20 @@
 from __future__ import annotations
 
+import asyncio
+import heapq
 import logging
+import time
+from collections import defaultdict
 from typing import TYPE_CHECKING
 
 import nio
 
-from .room import Room, RoomHistoryVisibility
-from .room_acl import Role
+from .api.kvstore import preload
+from .room import Room, RoomHistoryVisibility, RoomState, load_room_states
+from .room_acl import ConfigIndex, Role
 
 if TYPE_CHECKING:
-    from typing import Any, Iterable
+    from typing import Any, Awaitable, Callable, Iterable
 
     from .bot import Bot
 
@@ -17,9 +22,15 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 
+# number of slowest rooms logged for each startup phase
+_SLOWEST_ROOMS = 5
+
+
 class RoomTracker:
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: Bot, setup_concurrency: int = 16):
         self._bot = bot
+        # rooms set up and initialized in parallel at startup
+        self._setup_concurrency = setup_concurrency
         self._active_rooms: dict[str, Room] = dict()
 
         # map user_id -> [direct_message_room_id, ...]
@@ -28,18 +39,28 @@ class RoomTracker:
         # map user_id -> {room_id, } ...
         self._user_rooms: dict[str, set[str]] = dict()
 
+        # which rooms can be configured by whom
+        self.config_index = ConfigIndex()
+
+        # power level lookups served from the synced room state, and fetched from the homeserver
+        self.power_level_hits = 0
+        self.power_level_misses = 0
+
     async def init(self, joined_rooms: dict[str, nio.MatrixRoom]):
         """
         recreate all rooms given a list of room ids (e.g. because the matrix server says we're in them).
         this sets up room tracking based on the initial sync.
         """
-        for room_id, nio_room in joined_rooms.items():
+        room_states = await load_room_states(self._bot.db)
+
+        async def setup(room_id: str) -> None:
+            nio_room = joined_rooms[room_id]
             room = Room(
                 bot=self._bot,
                 nio_room=nio_room,
             )
 
-            if await room.setup():
+            if await room.setup(state=room_states.get(room_id, RoomState())):
                 self.add(room)
 
                 # set up room-user tracking from initial sync state
@@ -48,38 +69,92 @@ class RoomTracker:
             else:
                 logger.error("failed to initialize room %r in RoomTracker", nio_room)
 
+        await self._for_rooms("setup", joined_rooms.keys(), setup)
+
         # we split setup in two steps: so room plugins can interact!
         logger.info("initialized tracked rooms")
-        for room_id, room in self._active_rooms.items():
-            logger.info("- %s: mode: %r, name: %s", room_id, room.get_room_mode(), room.display_name)
+
+        await self._preload_storage()
+
+        async def init(room_id: str) -> None:
+            room = self._active_rooms[room_id]
+            logger.info("- %s: mode: %r, name: %s", room_id, room.mode, room.display_name)
             await room.init()
 
-        try:
-            self._bot.db.write("create temporary table joined_rooms(roomid text unique) strict;")
-            self._bot.db.write_many("insert or replace into joined_rooms(roomid) values (?);",
-                                    ((k,) for k in joined_rooms.keys()))
+        await self._for_rooms("init", list(self._active_rooms.keys()), init)
 
-            left_rooms = self._bot.db.read(
+        # the temporary table only exists in the transaction's connection
+        async with self._bot.db.transaction() as txn:
+            await txn.write("create temporary table joined_rooms(roomid text unique) strict;")
+            await txn.write_many("insert or replace into joined_rooms(roomid) values (?);",
+                                 ((k,) for k in joined_rooms.keys()))
+
+            left_rooms = await txn.read(
                 "select source_roomid from config_room where source_roomid not in joined_rooms "
                 "union "
                 "select target_roomid from config_room where target_roomid not in joined_rooms",
             )
 
-            for left_room in left_rooms:
-                await self._remove(left_room, removed_by=None)
+            await txn.write("drop table joined_rooms;")
 
-        finally:
-            self._bot.db.write("drop table if exists joined_rooms;")
+        for (left_room,) in left_rooms:
+            await self._remove(left_room, removed_by=None)
+
+    async def _for_rooms(self, phase: str, room_ids: Iterable[str],
+                         func: Callable[[str], Awaitable[None]]) -> None:
+        """
+        run func for all rooms, at most setup_concurrency at once.
+        a failure only affects its room.
+        """
+        limit = asyncio.Semaphore(self._setup_concurrency)
+        durations: dict[str, float] = dict()
+
+        async def run(room_id: str) -> None:
+            async with limit:
+                start = time.monotonic()
+                try:
+                    await func(room_id)
+                except Exception:
+                    logger.exception("room %s failed in %s", room_id, phase)
+                finally:
+                    durations[room_id] = time.monotonic() - start
+
+        start = time.monotonic()
+        async with asyncio.TaskGroup() as tasks:
+            for room_id in room_ids:
+                tasks.create_task(run(room_id))
+
+        slowest = heapq.nlargest(_SLOWEST_ROOMS, durations.items(), key=lambda item: item[1])
+        logger.info("room %s of %d rooms took %.01fs, slowest: %s",
+                    phase, len(durations), time.monotonic() - start,
+                    ", ".join(f"{room_id} {duration * 1000:.0f}ms" for room_id, duration in slowest))
 
     def add(self, room: Room):
         if room.room_id in self._active_rooms:
             return
         self._active_rooms[room.room_id] = room
 
+    async def _preload_storage(self) -> None:
+        """
+        load the storage of plugins with preload_storage for all rooms, with one query per plugin.
+        """
+        preload_rooms: dict[str, list[str]] = defaultdict(list)
+        for room_id, room in self._active_rooms.items():
+            for plugin_name, plugin in room.get_plugins().items():
+                if plugin.preload_storage:
+                    preload_rooms[plugin_name].append(room_id)
+
+        for plugin_name, room_ids in preload_rooms.items():
+            loaded = await preload(self._bot.db, self._bot.kv_cache, plugin_name, room_ids)
+            logger.debug("preloaded %d storage entries of plugin %s in %d rooms",
+                         loaded, plugin_name, len(room_ids))
+
     async def _remove(self, room_id: str, removed_by: str | None) -> None:
         for user_rooms in self._user_rooms.values():
             user_rooms.discard(room_id)
 
+        self.config_index.remove(room_id)
+
         room = self._active_rooms.pop(room_id, None)
         if room:
             logger.info(f"leaving room {room.room_id}...")
@@ -87,11 +162,13 @@ class RoomTracker:
         else:
             logger.info(f"leaving non-active room {room_id}...")
 
-        self._bot.db.write("delete from room_data where roomid=?;", (room_id,))
-        self._bot.db.write(
-            "delete from config_room where source_roomid=? or target_roomid=?;",
-            (room_id, room_id),
-        )
+        async with self._bot.db.transaction() as txn:
+            await txn.write("delete from room_data where roomid=?;", (room_id,))
+            txn.after_commit(lambda: self._bot.kv_cache.invalidate_table("room_data", room_id))
+            await txn.write(
+                "delete from config_room where source_roomid=? or target_roomid=?;",
+                (room_id, room_id),
+            )
 
         # room is deconstructed here.
 
@@ -277,16 +354,17 @@ class RoomTracker:
         logger.debug("%s: creating new config room", for_room)
         new_config_room = await self.get_private_room_with_user(user_id=inviter, name=name)
 
-        # the bot can be configured by the inviter only (and bot admins)
-        logger.debug("%s: granting config access to inviter %s", for_room, inviter)
-        with for_room.acl as acl:
-            acl.user_role_add(inviter, Role.config)
+        async with self._bot.db.transaction() as txn:
+            # the bot can be configured by the inviter only (and bot admins)
+            logger.debug("%s: granting config access to inviter %s", for_room, inviter)
+            async with for_room.acl as acl:
+                acl.user_role_add(inviter, Role.config)
 
-        # remember config room for interaction room
-        self._bot.db.write(
-            "insert or replace into config_room(source_roomid, target_roomid) values (?, ?);",
-            (new_config_room.room_id, for_room.room_id),
-        )
+            # remember config room for interaction room
+            await txn.write(
+                "insert or replace into config_room(source_roomid, target_roomid) values (?, ?);",
+                (new_config_room.room_id, for_room.room_id),
+            )
 
         return {new_config_room}
 
@@ -294,33 +372,34 @@ class RoomTracker:
         """
         which rooms can configure this the given room
         """
-        config_rooms = self._bot.db.read(
+        config_rooms = await self._bot.db.read(
             "select source_roomid from config_room where target_roomid=?;",
             (room_id,),
         )
-        ret: set[str] = set()
-        while True:
-            rooms = config_rooms.fetchmany()
-            if not rooms:
-                break
-            ret.update(room[0] for room in rooms)
-        return ret
+        return {room[0] for room in config_rooms}
 
     async def config_target_rooms(self, room_id: str) -> set[str]:
         """
         which rooms does the given room configure?
         """
-        configured_rooms = self._bot.db.read(
+        configured_rooms = await self._bot.db.read(
             "select target_roomid from config_room where source_roomid=?;",
             (room_id,),
         )
-        ret: set[str] = set()
-        while True:
-            rooms = configured_rooms.fetchmany()
-            if not rooms:
-                break
-            ret.update(room[0] for room in rooms)
-        return ret
+        return {room[0] for room in configured_rooms}
+
+    def configurable_rooms(self, user_id: str, level: int | None = None) -> dict[str, Room]:
+        """
+        which rooms can the given user configure, with the given power level?
+        """
+        if self._bot.is_admin(user_id):
+            return dict(self._active_rooms)
+
+        return {
+            room_id: room
+            for room_id in self.config_index.rooms(user_id, level)
+            if (room := self._active_rooms.get(room_id)) is not None
+        }
 
     async def is_config_room(self, room_id: str, config_room_for: str | None = None) -> bool:
         """
@@ -329,15 +408,15 @@ class RoomTracker:
         """
 
         if config_room_for:
-            has_configroom = self._bot.db.read(
+            has_configroom = await self._bot.db.read_one(
                 "select 1 from config_room where target_roomid=? and source_roomid=?;",
                 (config_room_for, room_id),
             )
-            return has_configroom.fetchone() is not None
+            return has_configroom is not None
 
         else:
-            has_configroom = self._bot.db.read(
+            has_configroom = await self._bot.db.read_one(
                 "select 1 from config_room where source_roomid=?;",
                 (room_id,),
             )
-            return has_configroom.fetchone() is not None
+            return has_configroom is not None
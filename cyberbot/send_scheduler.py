@@ -0,0 +1,285 @@
+"""
+ordered and rate limited sending of room messages.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import html
+import logging
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+import aiohttp
+import nio
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+# errors where a retry won't help
+_PERMANENT_ERRORS = frozenset({
+    "M_FORBIDDEN",
+    "M_NOT_FOUND",
+    "M_BAD_JSON",
+    "M_NOT_JSON",
+    "M_TOO_LARGE",
+    "M_UNKNOWN_TOKEN",
+    "M_MISSING_TOKEN",
+})
+
+# seconds to wait on rate limits without a retry hint
+_DEFAULT_RETRY_AFTER = 5.0
+
+# seconds before the first retry of a failed send, doubled for each further one
+_RETRY_DELAY = 1.0
+
+
+class SendError(Exception):
+    """
+    a message could not be sent.
+    """
+
+
+class _TokenBucket:
+    """
+    allows rate sends per second on average, and bursts of up to burst sends.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        # no tokens are handed out until then, set by rate limit responses
+        self._paused_until = 0.0
+
+    def pause(self, duration: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + duration)
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+@dataclass
+class _Message:
+    message_type: str
+    content: dict[str, Any]
+    # one per sender, merged notices have several
+    futures: list[asyncio.Future[str]]
+    # further notices can be merged into this one until then
+    coalesce_until: float | None = None
+    sending: bool = False
+    # the same for every attempt, so the homeserver drops duplicates of a retried send
+    tx_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+    def fail(self, exc: Exception) -> None:
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(exc)
+
+
+def _content_size(content: dict[str, Any]) -> int:
+    return len(content["body"].encode()) + len(content.get("formatted_body", "").encode())
+
+
+def _content_html(content: dict[str, Any]) -> str:
+    if content.get("format") == "org.matrix.custom.html":
+        return content["formatted_body"]
+    return html.escape(content["body"]).replace("\n", "<br/>")
+
+
+def _merge_content(first: dict[str, Any], second: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "msgtype": first["msgtype"],
+        "body": f"{first['body']}\n{second['body']}",
+        "format": "org.matrix.custom.html",
+        "formatted_body": f"{_content_html(first)}<br/>{_content_html(second)}",
+    }
+
+
+class SendScheduler:
+    """
+    sends room messages of the bot.
+
+    messages to one room are sent in order, one after another.
+    all rooms share a token bucket, which is paused when the homeserver rate limits us.
+    failed sends are retried unless the error is permanent.
+
+    with a coalesce_window, notices sent to a room within that many seconds
+    are merged into one message, as long as it stays below coalesce_bytes.
+    """
+
+    def __init__(self, room_send: Callable[..., Awaitable[nio.RoomSendResponse | nio.RoomSendError]],
+                 *, rate: float = 5.0, burst: int = 10, retries: int = 3,
+                 coalesce_window: float = 0.0, coalesce_bytes: int = 16384):
+        self._room_send = room_send
+        self._bucket = _TokenBucket(rate, burst)
+        self._retries = retries
+        self._coalesce_window = coalesce_window
+        self._coalesce_bytes = coalesce_bytes
+
+        # room_id -> messages to send, the first one is being sent
+        self._queues: dict[str, deque[_Message]] = dict()
+        # room_id -> task sending the queue
+        self._workers: dict[str, asyncio.Task] = dict()
+
+    def send(self, room_id: str, content: dict[str, Any],
+             message_type: str = "m.room.message", coalesce: bool = False) -> asyncio.Future[str]:
+        """
+        queue a message for the room.
+        the returned future resolves to the event id, or fails with a SendError.
+        coalesce allows merging the message with others of the same msgtype.
+        merged messages resolve to the same event id.
+        """
+        queue = self._queues.setdefault(room_id, deque())
+        coalesce = coalesce and self._coalesce_window > 0
+
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        if coalesce and queue and (merged := self._coalesce(queue[-1], message_type, content)):
+            merged.futures.append(future)
+            return future
+
+        message = _Message(message_type, content, [future])
+        if coalesce:
+            message.coalesce_until = time.monotonic() + self._coalesce_window
+        queue.append(message)
+
+        if room_id not in self._workers:
+            self._workers[room_id] = asyncio.create_task(self._work(room_id))
+
+        return future
+
+    def _coalesce(self, message: _Message, message_type: str, content: dict[str, Any]) -> _Message | None:
+        """
+        merge the content into the queued message, if possible.
+        """
+        if (message.sending
+                or message.coalesce_until is None
+                or time.monotonic() >= message.coalesce_until
+                or message.message_type != message_type
+                or message.content["msgtype"] != content["msgtype"]):
+            return None
+
+        merged = _merge_content(message.content, content)
+        if _content_size(merged) > self._coalesce_bytes:
+            return None
+
+        message.content = merged
+        return message
+
+    def rate_limited(self, retry_after_ms: int | None) -> None:
+        """
+        the homeserver rejected a request because of its rate limit.
+        """
+        retry_after = retry_after_ms / 1000 if retry_after_ms else _DEFAULT_RETRY_AFTER
+        logger.info("rate limited by homeserver, pausing sends for %.01fs", retry_after)
+        self._bucket.pause(retry_after)
+
+    def pending(self) -> int:
+        """
+        number of messages not sent yet.
+        """
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def close(self) -> None:
+        """
+        stop sending, the pending messages fail.
+        """
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        for queue in self._queues.values():
+            for message in queue:
+                message.fail(SendError("send scheduler was closed"))
+        self._queues.clear()
+
+    async def _work(self, room_id: str) -> None:
+        queue = self._queues[room_id]
+        try:
+            while queue:
+                message = queue[0]
+                if message.coalesce_until is not None:
+                    # wait for more notices to merge
+                    await asyncio.sleep(message.coalesce_until - time.monotonic())
+                message.sending = True
+
+                # skip it only if nobody waits for it anymore
+                if not all(future.done() for future in message.futures):
+                    try:
+                        event_id = await self._send(room_id, message)
+                    except SendError as exc:
+                        message.fail(exc)
+                    except Exception as exc:
+                        # don't let the rest of the queue starve
+                        logger.exception("failed to send to %s", room_id)
+                        error = SendError(f"failed to send to {room_id}: {type(exc).__name__}: {exc}")
+                        error.__cause__ = exc
+                        message.fail(error)
+                    else:
+                        for future in message.futures:
+                            if not future.done():
+                                future.set_result(event_id)
+                queue.popleft()
+        finally:
+            del self._workers[room_id]
+            if not queue:
+                del self._queues[room_id]
+
+    async def _send(self, room_id: str, message: _Message) -> str:
+        failures = 0
+        while True:
+            await self._bucket.acquire()
+
+            try:
+                response = await self._room_send(
+                    room_id=room_id,
+                    message_type=message.message_type,
+                    content=message.content,
+                    tx_id=message.tx_id,
+                    ignore_unverified_devices=True,
+                )
+            except (aiohttp.ClientError, TimeoutError) as exc:
+                error = f"{type(exc).__name__}: {exc}"
+            except nio.LocalProtocolError as exc:
+                raise SendError(f"failed to send to {room_id}: {exc}") from exc
+            else:
+                if isinstance(response, nio.RoomSendResponse):
+                    return response.event_id
+
+                if response.status_code == "M_LIMIT_EXCEEDED":
+                    # not a failure, just wait as long as the server wants
+                    self.rate_limited(response.retry_after_ms)
+                    continue
+
+                if response.status_code in _PERMANENT_ERRORS:
+                    raise SendError(f"failed to send to {room_id}: {response}")
+                error = str(response)
+
+            failures += 1
+            if failures > self._retries:
+                raise SendError(f"failed to send to {room_id} after {failures} attempts: {error}")
+
+            delay = _RETRY_DELAY * 2 ** (failures - 1)
+            logger.warning("sending to %s failed, retrying in %.0fs: %s", room_id, delay, error)
+            await asyncio.sleep(delay)
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+from ..api.service import Service
+from ..db_maintenance import MaintenanceTask
+
+if TYPE_CHECKING:
+    from ..bot import Bot
+    from ..db_maintenance import MaintenanceResult
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseMaintenance(Service):
+    """
+    periodically runs the database housekeeping tasks,
+    each once the database was idle for a while.
+    """
+
+    def __init__(self, bot: Bot) -> None:
+        super().__init__(bot)
+
+        # seconds between maintenance runs
+        self._interval = 6 * 60 * 60.0
+        # seconds without database use before a task is started
+        self._idle_time = 30.0
+        # seconds each task may take
+        self._time_limit = 10.0
+        self._tasks = list(MaintenanceTask)
+
+        self._task: asyncio.Task | None = None
+
+        # latest result of each task
+        self.results: dict[MaintenanceTask, MaintenanceResult] = dict()
+
+    async def setup(self) -> None:
+        config = self._bot.get_config("db_maintenance") or dict()
+
+        self._interval = float(config.get("interval_s", self._interval))
+        self._idle_time = float(config.get("idle_s", self._idle_time))
+        self._time_limit = float(config.get("time_limit_s", self._time_limit))
+        if "tasks" in config:
+            self._tasks = [MaintenanceTask(name) for name in config["tasks"]]
+
+    async def start(self) -> None:
+        if self._task is None and self._tasks:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.run_tasks()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("database maintenance failed")
+
+    async def _wait_idle(self) -> None:
+        db = self._bot.db
+        while (idle := db.idle_time()) < self._idle_time:
+            await asyncio.sleep(self._idle_time - idle)
+
+    async def run_tasks(self) -> None:
+        for task in self._tasks:
+            await self._wait_idle()
+
+            result = await self._bot.db.maintain(task, self._time_limit)
+            self.results[task] = result
+            logger.info(
+                "database maintenance %s took %.01fms, reclaimed %d KiB%s",
+                task.value, result.duration * 1000, result.reclaimed // 1024,
+                " (time limit reached)" if result.interrupted else "",
+            )
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+from ..api.kvstore import delete_expired
+from ..api.service import Service
+
+if TYPE_CHECKING:
+    from ..bot import Bot
+
+logger = logging.getLogger(__name__)
+
+
+class StorageExpiry(Service):
+    """
+    deletes expired plugin storage entries in the background.
+    reads already skip them, this just frees the space.
+    """
+
+    def __init__(self, bot: Bot) -> None:
+        super().__init__(bot)
+
+        # seconds between sweeps
+        self._interval = 60.0
+        # entries deleted per table and commit
+        self._batch_size = 500
+
+        self._task: asyncio.Task | None = None
+
+    async def setup(self) -> None:
+        config = self._bot.get_config("storage_expiry") or dict()
+
+        self._interval = float(config.get("interval_s", self._interval))
+        self._batch_size = int(config.get("batch_size", self._batch_size))
+        if self._batch_size < 1:
+            raise ValueError("storage_expiry.batch_size must be positive")
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("deleting expired storage entries failed")
+
+    async def sweep(self) -> int:
+        """
+        delete all expired entries, one batch at a time so other writes aren't blocked for long.
+        """
+        total = 0
+        while deleted := await delete_expired(self._bot.db, self._batch_size):
+            total += deleted
+        if total:
+            logger.debug("deleted %d expired storage entries", total)
+        return total
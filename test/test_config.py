@@ -0,0 +1,38 @@
+import pytest
+from pydantic import ValidationError
+
+from cyberbot.config import BotConfig, StorageConfig
+
+
+def test_bot_config():
+    config = BotConfig(name="bot", rooms_allowed=[], admins=[])
+    assert config.room_setup_concurrency == 16
+    assert config.send_rate == 5
+
+
+@pytest.mark.parametrize("setting", [
+    {"room_setup_concurrency": 0},
+    {"send_rate": 0},
+    {"send_burst": 0},
+    {"send_retries": -1},
+    {"send_coalesce_ms": -1},
+    {"send_coalesce_bytes": 0},
+])
+def test_bot_config_invalid(setting):
+    with pytest.raises(ValidationError):
+        BotConfig(name="bot", rooms_allowed=[], admins=[], **setting)
+
+
+@pytest.mark.parametrize("setting", [
+    {"snapshot_interval_s": 0},
+    {"read_connections": 0},
+    {"commit_window_ms": -1},
+    {"slow_query_ms": -1},
+    {"quota_keys": 0},
+    {"quota_bytes": -1},
+    {"kv_cache_size": -1},
+])
+def test_storage_config_invalid(setting):
+    StorageConfig(database_path="bot.db", cryptostate_path="crypto")
+    with pytest.raises(ValidationError):
+        StorageConfig(database_path="bot.db", cryptostate_path="crypto", **setting)
@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from cyberbot.database import Database
+from cyberbot.db_backend import MemoryBackend
+from cyberbot.db_maintenance import MaintenanceTask
+from cyberbot.migrations import MIGRATIONS, DataMigration, Migration
+
+
+def run_db(tmp_path, test, backend=None, **db_args):
+    async def runner():
+        db = Database(backend or tmp_path / "bot.db", **db_args)
+        try:
+            await db.migrate()
+            await test(db)
+        finally:
+            await db.close()
+
+    asyncio.run(runner())
+
+
+def test_read_write(tmp_path):
+    async def test(db: Database):
+        changed = await db.write("insert into state(key, value) values (?, ?);", ("lol", "rofl"))
+        assert changed == 1
+
+        assert await db.read("select key, value from state;") == [("lol", "rofl")]
+        assert await db.read_one("select value from state where key=?;", ("nope",)) is None
+
+    run_db(tmp_path, test)
+
+
+def test_transaction_rollback(tmp_path):
+    async def test(db: Database):
+        with pytest.raises(RuntimeError):
+            async with db.transaction() as txn:
+                await txn.write("insert into state(key, value) values (?, ?);", ("a", "1"))
+                assert await txn.read_one("select value from state where key='a';") == ("1",)
+                raise RuntimeError("abort")
+
+        assert await db.read("select * from state;") == []
+
+        async with db.transaction() as txn:
+            await txn.write_many("insert into state(key, value) values (?, ?);", (("a", "1"), ("b", "2")))
+
+        assert await db.read("select key from state order by key;") == [("a",), ("b",)]
+
+    run_db(tmp_path, test)
+
+
+def test_transaction_cancel(tmp_path):
+    async def test(db: Database):
+        committing = threading.Event()
+        commit = db._commit
+
+        def slow_commit():
+            committing.set()
+            time.sleep(0.05)
+            commit()
+
+        db._commit = slow_commit
+        called = asyncio.Event()
+
+        async def write():
+            async with db.transaction() as txn:
+                await txn.write("insert into state(key, value) values (?, ?);", ("a", "1"))
+                txn.after_commit(called.set)
+
+        task = asyncio.create_task(write())
+        await asyncio.to_thread(committing.wait)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # committed anyway, and the callbacks know about it
+        await asyncio.wait_for(called.wait(), timeout=1)
+        assert await db.read("select key from state;") == [("a",)]
+
+    run_db(tmp_path, test)
+
+
+def test_transaction_routing(tmp_path):
+    async def test(db: Database):
+        async with db.transaction():
+            # plain calls in the block use the transaction
+            await db.write("insert into state(key, value) values (?, ?);", ("a", "1"))
+            assert await db.read_one("select value from state where key='a';") == ("1",)
+
+            # nested blocks are savepoints
+            with pytest.raises(RuntimeError):
+                async with db.transaction():
+                    await db.write("insert into state(key, value) values (?, ?);", ("b", "2"))
+                    raise RuntimeError("abort")
+
+            async with db.transaction():
+                await db.write("insert into state(key, value) values (?, ?);", ("c", "3"))
+
+        assert await db.read("select key from state order by key;") == [("a",), ("c",)]
+
+        # the transaction is no longer used after the block
+        await db.write("insert into state(key, value) values (?, ?);", ("d", "4"))
+        assert await db.read_one("select count(*) from state;") == (3,)
+
+    run_db(tmp_path, test)
+
+
+def test_wal_readers(tmp_path):
+    async def test(db: Database):
+        assert await db.read_one("pragma journal_mode;") == ("wal",)
+
+        await db.write_many("insert into state(key, value) values (?, ?);",
+                            ((str(i), "val") for i in range(10)))
+
+        # reads from the pool see committed writes, also while the writer is busy
+        deleted = asyncio.Event()
+        done = asyncio.Event()
+
+        async def writer():
+            async with db.transaction() as txn:
+                await txn.write("delete from state;")
+                deleted.set()
+                await done.wait()
+
+        writer_task = asyncio.create_task(writer())
+        await deleted.wait()
+        results = await asyncio.gather(*(db.read("select count(*) from state;") for _ in range(8)))
+        assert all(result == [(10,)] for result in results)
+        done.set()
+        await writer_task
+
+        assert await db.read_one("select count(*) from state;") == (0,)
+
+    run_db(tmp_path, test, wal=True, read_connections=2)
+
+
+def test_group_commit(tmp_path):
+    async def test(db: Database):
+        commits = 0
+
+        def count_commit():
+            nonlocal commits
+            commits += 1
+
+        await db._run(db._connection.set_trace_callback,
+                      lambda sql: count_commit() if sql == "COMMIT" else None)
+
+        # the duplicate key fails, but the other writes of the batch are committed
+        results = await asyncio.gather(
+            *(db.write("insert into state(key, value) values (?, ?);", (str(i), "val")) for i in range(10)),
+            db.write("insert into state(key, value) values (?, ?);", ("1", "duplicate")),
+            return_exceptions=True,
+        )
+
+        assert results[:10] == [1] * 10
+        assert isinstance(results[10], sqlite3.IntegrityError)
+        assert commits == 1
+        assert await db.read_one("select count(*) from state;") == (10,)
+
+    run_db(tmp_path, test)
+
+
+def test_migrations(tmp_path):
+    migrations = [
+        *MIGRATIONS,
+        Migration("add counter", "alter table state add column counter int;"),
+    ]
+    data_migrations = [
+        DataMigration(
+            "count",
+            "update state set counter = 0 where rowid in "
+            "(select rowid from state where counter is null limit :limit);",
+            chunk_size=3,
+        ),
+    ]
+
+    async def test(db: Database):
+        await db.write_many("insert into state(key, value) values (?, ?);", ((str(i), "val") for i in range(10)))
+
+        await db.migrate(migrations, data_migrations)
+        assert await db.read_one("pragma user_version;") == (len(migrations),)
+
+        await db._data_migration_task
+        assert await db.read_one("select count(*) from state where counter = 0;") == (10,)
+
+        # only version and data migration state lookups for the current version
+        statements: list[str] = []
+        await db._run(db._connection.set_trace_callback, statements.append)
+        await db.migrate(migrations, data_migrations)
+        assert [stmt for stmt in statements if stmt not in ("BEGIN", "ROLLBACK")] == [
+            "pragma user_version;",
+            "select key from state where key like 'data_migration:%';",
+        ]
+        assert db._data_migration_task.done()
+
+    run_db(tmp_path, test)
+
+
+def test_statement_stats(tmp_path, caplog):
+    async def test(db: Database):
+        for i in range(5):
+            await db.write("insert into state(key, value) values (?, ?);", (str(i), "val"))
+            await db.read("select   value from state\n where key=?;", (str(i),))
+
+        summary = {stmt.sql: stmt for stmt in db.stats.summary()}
+        select = summary["select value from state where key=?"]
+        assert select.count == 5
+        assert 0 < select.p50 <= select.p99
+        assert summary["insert into state(key, value) values (?, ?)"].count == 5
+        assert summary["commit"].count == 5
+
+        # everything is slow now
+        db.stats._slow_threshold = 0
+        with caplog.at_level(logging.WARNING):
+            await db.read("select count(*) from state;")
+        assert "select count(*) from state" in caplog.text
+        assert "test_database.py" in caplog.text
+
+    run_db(tmp_path, test)
+
+
+def test_memory_backend(tmp_path):
+    snapshot_path = tmp_path / "snapshot.db"
+
+    async def fill(db: Database):
+        await db.write("insert into state(key, value) values (?, ?);", ("a", "1"))
+        assert not snapshot_path.exists()
+
+    async def check(db: Database):
+        assert await db.read("select key, value from state;") == [("a", "1")]
+
+    # snapshotted at shutdown only
+    run_db(tmp_path, fill, backend=MemoryBackend(snapshot_path, snapshot_interval=None))
+    run_db(tmp_path, check, backend=MemoryBackend(snapshot_path))
+
+    with pytest.raises(ValueError):
+        Database(MemoryBackend(), wal=True)
+
+
+def test_maintenance(tmp_path):
+    async def test(db: Database):
+        await db.write_many("insert into state(key, value) values (?, ?);",
+                            ((str(i), "x" * 1000) for i in range(1000)))
+        await db.write("delete from state;")
+
+        for task in MaintenanceTask:
+            result = await db.maintain(task, time_limit=10)
+            assert not result.interrupted
+
+            match task:
+                case MaintenanceTask.incremental_vacuum:
+                    assert result.reclaimed > 0
+                case MaintenanceTask.wal_checkpoint:
+                    assert result.reclaimed > 0
+
+        assert await db.read_one("pragma auto_vacuum;") == (2,)
+        assert await db.read_one("pragma wal_checkpoint;") == (0, 0, 0)
+
+        # the connection is usable as before
+        await db.write("insert into state(key, value) values (?, ?);", ("a", "1"))
+        assert await db.read("select key from state;") == [("a",)]
+
+        result = await db.maintain(MaintenanceTask.analyze, time_limit=0)
+        assert result.interrupted
+
+    run_db(tmp_path, test, wal=True)
+
+
+def test_maintenance_vacuum(tmp_path):
+    async def test(db: Database):
+        await db.write_many("insert into state(key, value) values (?, ?);",
+                            ((str(i), "x" * 4000) for i in range(5000)))
+        await db.write("delete from state;")
+        (free_pages,) = await db.read_one("pragma freelist_count;")
+        assert free_pages > 4000
+
+        # a page per statement would take far longer
+        result = await db.maintain(MaintenanceTask.incremental_vacuum, time_limit=2)
+        assert not result.interrupted
+        assert await db.read_one("pragma freelist_count;") == (0,)
+        (page_size,) = await db.read_one("pragma page_size;")
+        assert result.reclaimed >= free_pages * page_size
+
+    run_db(tmp_path, test)
+
+
+def test_maintenance_no_conversion(tmp_path):
+    # a database from before incremental auto_vacuum
+    connection = sqlite3.connect(tmp_path / "bot.db")
+    connection.execute("create table lol(a);")
+    connection.close()
+
+    async def test(db: Database):
+        for _ in range(2):
+            result = await db.maintain(MaintenanceTask.incremental_vacuum, time_limit=10)
+            assert not result.interrupted
+            assert result.reclaimed == 0
+        assert await db.read_one("pragma auto_vacuum;") == (0,)
+
+    run_db(tmp_path, test)
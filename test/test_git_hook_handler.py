@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from cyberbot.modules.gitlab.formatting import GitLabFormatter
+from cyberbot.modules.util.git_hook_handler import GitHookHandler
+
+
+class FakeAPI:
+    def __init__(self):
+        self.log = logging.getLogger("test")
+        self.storage = SimpleNamespace(get_json=self._get_json)
+        # event_id -> html
+        self.messages: dict[str, str] = dict()
+
+    async def _get_json(self, key, model):
+        return {"emoji": False}
+
+    def get_service(self, name):
+        return None
+
+    async def send_html(self, html, text="", notice=False, coalesce=True):
+        event_id = f"${len(self.messages)}"
+        self.messages[event_id] = html
+        return event_id
+
+    async def edit_html(self, event_id, html, text="", notice=False):
+        self.messages[event_id] = html
+
+
+def _job(pipeline_id: int, build_id: int, name: str, status: str) -> dict:
+    return {
+        "pipeline_id": pipeline_id, "build_id": build_id,
+        "build_name": name, "build_stage": "test", "build_status": status,
+        "project": {"id": 1, "name": "lol", "description": "", "web_url": "https://git.lol/lol"},
+    }
+
+
+def test_pipeline_edits():
+    async def test():
+        api = FakeAPI()
+        handler = GitHookHandler(api, git_variant="gitlab", formatter=GitLabFormatter(), info_url="")
+
+        await handler.handle_git_hook("", "Job Hook", _job(1, 10, "build", "running"))
+        await handler.handle_git_hook("", "Job Hook", _job(1, 11, "check", "running"))
+        await handler.handle_git_hook("", "Job Hook", _job(2, 20, "build", "running"))
+        await handler.handle_git_hook("", "Job Hook", _job(1, 10, "build", "success"))
+
+        # one message per pipeline, with the latest status of each job
+        assert len(api.messages) == 2
+        pipeline_1 = api.messages["$0"]
+        assert "build(test): <code>success</code>" in pipeline_1
+        assert "check(test): <code>running</code>" in pipeline_1
+        assert "running" not in pipeline_1.split("<br/>")[0]
+
+    asyncio.run(test())
@@ -0,0 +1,373 @@
+import asyncio
+import contextlib
+import time
+
+import pytest
+from pydantic import BaseModel, ValidationError
+
+from cyberbot.api.kvstore import (
+    KVCache,
+    KVStore,
+    StorageBus,
+    StorageQuota,
+    StorageQuotaExceeded,
+    StorageUsage,
+    delete_expired,
+    get_storage_usage,
+    preload,
+)
+from cyberbot.database import Database
+from cyberbot.db_backend import MemoryBackend
+
+
+def run_kv(test):
+    async def runner():
+        db = Database(MemoryBackend())
+        try:
+            await db.migrate()
+            await test(db)
+        finally:
+            await db.close()
+
+    asyncio.run(runner())
+
+
+def test_scopes():
+    async def test(db: Database):
+        kv = KVStore(db, "plugin", "!room:lol")
+        other_room = KVStore(db, "plugin", "!other:lol")
+        other_plugin = KVStore(db, "other", "!room:lol")
+
+        await kv.set("key", "room_plugin")
+        await kv.set("key", "room", plugin=False)
+        await kv.set("key", "plugin", room=False)
+
+        assert await kv.get("key") == "room_plugin"
+        assert await kv.get("key", plugin=False) == "room"
+        assert await kv.get("key", room=False) == "plugin"
+
+        assert await other_room.get("key") is None
+        assert await other_room.get("key", room=False) == "plugin"
+        assert await other_plugin.get("key") is None
+        assert await other_plugin.get("key", plugin=False) == "room"
+
+        await kv.set("other", "value")
+        assert sorted(await kv.keys()) == ["key", "other"]
+
+        await kv.rm("key")
+        assert await kv.get("key") is None
+        assert await kv.get("key", plugin=False) == "room"
+
+        with pytest.raises(RuntimeError):
+            await kv.get("key", room=False, plugin=False)
+
+    run_kv(test)
+
+
+def test_transaction():
+    async def test(db: Database):
+        kv = KVStore(db, "plugin", "!room:lol")
+
+        with pytest.raises(RuntimeError):
+            async with kv.transaction():
+                await kv.set("a", "1")
+                assert await kv.get("a") == "1"
+                raise RuntimeError("abort")
+        assert await kv.get("a") is None
+
+        async with kv.transaction():
+            for i in range(10):
+                await kv.set(f"key{i}", str(i))
+            await kv.rm("key0")
+        assert len(await kv.keys()) == 9
+
+    run_kv(test)
+
+
+def test_storage_usage():
+    async def test(db: Database):
+        kv = KVStore(db, "plugin", "!room:lol", quota=StorageQuota(max_keys=3, max_bytes=100))
+
+        await kv.set("a", "12345")
+        await kv.set("a", "123")
+        await kv.set("b", "x" * 10)
+        await kv.set("c", "room", plugin=False)
+        assert await get_storage_usage(db, 10) == [
+            StorageUsage("!room:lol", "plugin", keys=2, bytes=len("a123") + len("b") + 10),
+            StorageUsage("!room:lol", None, keys=1, bytes=len("croom")),
+        ]
+
+        with pytest.raises(StorageQuotaExceeded):
+            await kv.set("d", "x" * 100)
+        await kv.set("d", "x" * 10)
+        with pytest.raises(StorageQuotaExceeded):
+            await kv.set("e", "")
+        # replacing a key needs no additional key
+        await kv.set("d", "")
+
+        await kv.rm("a")
+        await kv.rm("b")
+        await kv.rm("d")
+        assert await get_storage_usage(db, 10) == [StorageUsage("!room:lol", None, keys=1, bytes=5)]
+
+    run_kv(test)
+
+
+def test_cache():
+    async def test(db: Database):
+        cache = KVCache(size=2)
+        kv = KVStore(db, "plugin", "!room:lol", cache=cache)
+        uncached = KVStore(db, "plugin", "!room:lol")
+
+        await kv.set("a", "1")
+        assert await kv.get("a") == "1"
+        assert await kv.get("a") == "1"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # cached values are used until they're written through the cache
+        await uncached.set("a", "2")
+        assert await kv.get("a") == "1"
+        await kv.set("a", "3")
+        assert await kv.get("a") == "3"
+
+        # least recently used entries are dropped
+        assert await kv.get("b") is None
+        assert await kv.get("c") is None
+        assert len(cache) == 2
+        misses = cache.misses
+        await kv.get("a")
+        assert cache.misses == misses + 1
+
+        # rolled back writes don't change the cache, committed ones invalidate it
+        assert await kv.get("a") == "3"
+        with pytest.raises(RuntimeError):
+            async with kv.transaction():
+                await kv.set("a", "4")
+                assert await kv.get("a") == "4"
+                raise RuntimeError("abort")
+        assert await kv.get("a") == "3"
+
+        async with kv.transaction():
+            await kv.rm("a")
+        assert await kv.get("a") is None
+
+    run_kv(test)
+
+
+def test_batch():
+    async def test(db: Database):
+        cache = KVCache(size=100)
+        kv = KVStore(db, "plugin", "!room:lol", quota=StorageQuota(max_keys=5), cache=cache)
+
+        assert await kv.set_many({"user:a": "1", "user:b": "2", "user:c": "3", "other": "x"}) == 4
+        assert await kv.get("user:a") == "1"
+
+        assert await kv.get_many(["user:a", "user:b", "nope"]) == {"user:a": "1", "user:b": "2", "nope": None}
+        # mixed cache hits and misses
+        assert await kv.get_many(["user:a", "user:c"]) == {"user:a": "1", "user:c": "3"}
+
+        with pytest.raises(StorageQuotaExceeded):
+            await kv.set_many({"new1": "", "new2": ""})
+        assert await kv.get("new1") is None
+        await kv.set_many({"user:a": "10", "new1": ""})
+
+        assert await kv.delete_prefix("user:") == 3
+        assert await kv.get_many(["user:a", "other"]) == {"user:a": None, "other": "x"}
+        assert sorted(await kv.keys()) == ["new1", "other"]
+
+        assert await kv.delete_prefix("") == 2
+        assert await kv.keys() == []
+
+    run_kv(test)
+
+
+class _Record(BaseModel):
+    name: str
+    count: int = 0
+
+
+def test_json():
+    async def test(db: Database):
+        cache = KVCache(size=100)
+        kv = KVStore(db, "plugin", "!room:lol", cache=cache)
+
+        assert await kv.get_json("records", list[_Record]) is None
+
+        await kv.set_json("records", [_Record(name="a"), _Record(name="b", count=2)])
+        records = await kv.get_json("records", list[_Record])
+        assert records == [_Record(name="a"), _Record(name="b", count=2)]
+        # decoded once, then served from the cache
+        assert await kv.get_json("records", list[_Record]) is records
+        assert await kv.get_json("records") == [{"name": "a", "count": 0}, {"name": "b", "count": 2}]
+
+        await kv.set_json("records", [])
+        assert await kv.get_json("records", list[_Record]) == []
+
+        with pytest.raises(ValidationError):
+            await kv.set_json("records", [{"count": 1}])
+            await kv.get_json("records", list[_Record])
+
+    run_kv(test)
+
+
+def test_scan():
+    async def test(db: Database):
+        kv = KVStore(db, "plugin", "!room:lol")
+        await kv.set_many({f"user:{i:02d}": str(i) for i in range(25)} | {"other": "x", "user": "y"})
+
+        async def scan(**args):
+            return [key async for key in kv.scan(page_size=4, **args)]
+
+        assert await scan(prefix="user:") == [f"user:{i:02d}" for i in range(25)]
+        assert await scan(prefix="user:", start="user:10", end="user:13") == ["user:10", "user:11", "user:12"]
+        assert await scan(start="user:2") == ["user:20", "user:21", "user:22", "user:23", "user:24"]
+        assert await scan(end="user") == ["other"]
+        assert await scan(prefix="nope") == []
+        assert len(await scan()) == 27
+
+        items = [item async for item in kv.scan_items(prefix="user:0", page_size=3)]
+        assert items == [(f"user:0{i}", str(i)) for i in range(10)]
+
+        # the key after the prefix skips the surrogates
+        await kv.set_many({"a\ud7ff": "1", "a\ud7ffb": "2", "a\ue000": "3"})
+        assert await scan(prefix="a\ud7ff") == ["a\ud7ff", "a\ud7ffb"]
+        assert await kv.delete_prefix("a\ud7ff") == 2
+
+    run_kv(test)
+
+
+def test_expiry(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    async def test(db: Database):
+        nonlocal now
+        cache = KVCache(size=100)
+        kv = KVStore(db, "plugin", "!room:lol", cache=cache)
+
+        await kv.set("token", "secret", ttl=10)
+        await kv.set_many({"a": "1", "b": "2"}, ttl=20)
+        await kv.set("persistent", "x")
+        assert await kv.get("token") == "secret"
+
+        now += 10
+        assert await kv.get("token") is None
+        assert await kv.get_many(["a", "token"]) == {"a": "1", "token": None}
+        assert sorted(await kv.keys()) == ["a", "b", "persistent"]
+
+        now += 10
+        assert [key async for key in kv.scan()] == ["persistent"]
+
+        # expired rows are still stored until they're deleted
+        assert await db.read_one("select count(*) from room_plugin_data;") == (4,)
+        assert await delete_expired(db, limit=2) == 2
+        assert await delete_expired(db, limit=2) == 1
+        assert await delete_expired(db, limit=2) == 0
+        assert await kv.keys() == ["persistent"]
+
+        # expired keys don't count for the quota
+        quota_kv = KVStore(db, "quota", "!room:lol", quota=StorageQuota(max_keys=3))
+        await quota_kv.set("old", "x", ttl=5)
+        await quota_kv.set("a", "1")
+        await quota_kv.set("b", "2")
+        now += 10
+        await quota_kv.set("c", "3")
+        assert sorted(await quota_kv.keys()) == ["a", "b", "c"]
+        with pytest.raises(StorageQuotaExceeded, match="4 keys"):
+            await quota_kv.set("d", "4")
+
+        # setting without ttl makes it persistent again
+        await kv.set("a", "1", ttl=5)
+        await kv.set("a", "1")
+        now += 10
+        assert await kv.get("a") == "1"
+
+    run_kv(test)
+
+
+def test_watch():
+    async def test(db: Database):
+        bus = StorageBus()
+        kv = KVStore(db, "plugin", "!room:lol", bus=bus)
+        other_room = KVStore(db, "plugin", "!other:lol", bus=bus)
+
+        changes: list[str | None] = []
+        watching = asyncio.Event()
+
+        async def watch():
+            async with contextlib.aclosing(kv.watch("shared", room=False)) as watcher:
+                # subscribes at the first iteration step
+                step = asyncio.ensure_future(anext(watcher))
+                await asyncio.sleep(0)
+                watching.set()
+                changes.append(await step)
+                async for value in watcher:
+                    changes.append(value)
+                    if len(changes) == 4:
+                        break
+
+        task = asyncio.create_task(watch())
+        await watching.wait()
+
+        await other_room.set("shared", "1", room=False)
+        await other_room.set("unrelated", "x", room=False)
+        with pytest.raises(RuntimeError):
+            async with other_room.transaction():
+                await other_room.set("shared", "rolled back", room=False)
+                raise RuntimeError("abort")
+        async with other_room.transaction():
+            await other_room.set("shared", "2", room=False)
+        await other_room.rm("shared", room=False)
+        await other_room.set("shared", "3", room=False)
+        await other_room.delete_prefix("sha", room=False)
+
+        await asyncio.wait_for(task, 1)
+        assert changes == ["1", "2", None, "3"]
+        assert not bus._watchers
+
+    run_kv(test)
+
+
+def test_preload():
+    async def test(db: Database):
+        for room in ("!a:lol", "!b:lol", "!c:lol"):
+            await KVStore(db, "plugin", room).set_many({"x": room, "y": "1"})
+
+        cache = KVCache(size=100)
+        kv_a = KVStore(db, "plugin", "!a:lol", cache=cache)
+        kv_b = KVStore(db, "plugin", "!b:lol", cache=cache)
+
+        assert await preload(db, cache, "plugin", ["!a:lol", "!b:lol"]) == 4
+        assert len(cache) == 4
+        # already loaded
+        await kv_a.preload()
+
+        assert await kv_a.get("x") == "!a:lol"
+        assert await kv_b.get("y") == "1"
+        # missing keys of preloaded scopes are known, too
+        assert await kv_b.get("nope") is None
+        assert cache.misses == 0
+
+        # after a write, missing keys are fetched again
+        await kv_a.set("z", "new")
+        assert await kv_a.get("z") == "new"
+        assert await kv_a.get("nope") is None
+        assert cache.misses == 2
+        assert await kv_b.get("nope") is None
+        assert cache.misses == 2
+
+        # more entries than the cache holds
+        small_cache = KVCache(size=3)
+        assert await preload(db, small_cache, "plugin", ["!a:lol", "!b:lol"]) == 0
+        assert await KVStore(db, "plugin", "!a:lol", cache=small_cache).get("x") == "!a:lol"
+
+        # evicted entries keep the scope incomplete
+        scope = ("room_plugin_data", "!a:lol", "plugin")
+        keys = [(*scope, key) for key in ("k1", "k2", "k3", "k4")]
+        for key in keys:
+            small_cache.store(key, "1", small_cache.generation)
+        small_cache.mark_complete(scope, small_cache.generation, keys)
+        assert not small_cache.is_complete(scope)
+        assert small_cache.lookup(keys[0]) == (False, None)
+
+    run_kv(test)
@@ -18,3 +18,12 @@ def test_config():
         cli.parse_args(["room", "--help"])
 
     assert re.match(r"^usage:\s+\<config\>\s+room", err.value.message)
+
+
+def test_stats_top():
+    cli = Config(api=None)._get_parser()
+
+    assert cli.parse_args(["stats", "db", "--top", "3"]).top == 3
+    for top in ("0", "-1", "lol"):
+        with pytest.raises(ArgumentError, match="--top"):
+            cli.parse_args(["stats", "storage", "--top", top])
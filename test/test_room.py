@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+import nio
+
+from cyberbot.database import Database
+from cyberbot.db_backend import MemoryBackend
+from cyberbot.room import Room, RoomMode, RoomState, load_room_states
+from cyberbot.room_tracker import RoomTracker
+
+
+def test_power_levels():
+    requests = []
+
+    async def room_get_state_event(room_id, event_type):
+        requests.append((room_id, event_type))
+        return nio.RoomGetStateEventResponse({"users": {"@user:lol": 50}}, event_type, "", room_id)
+
+    async def test():
+        rooms = SimpleNamespace(power_level_hits=0, power_level_misses=0)
+        bot = SimpleNamespace(rooms=rooms, mxclient=SimpleNamespace(room_get_state_event=room_get_state_event))
+        nio_room = nio.MatrixRoom("!room:lol", "@bot:lol")
+        room = Room(bot, nio_room)
+
+        # no synced state yet: fetched once
+        assert await room.get_user_power_level("@user:lol") == 50
+        assert await room.get_user_power_level("@other:lol") == 0
+        assert len(requests) == 1
+
+        # the synced state is used once there
+        nio_room.power_levels.users["@user:lol"] = 100
+        room.on_power_levels_event()
+        assert await room.get_user_power_level("@user:lol") == 100
+        assert len(requests) == 1
+        assert (rooms.power_level_hits, rooms.power_level_misses) == (2, 1)
+
+    asyncio.run(test())
+
+
+def test_load_room_states():
+    async def test():
+        db = Database(MemoryBackend())
+        try:
+            await db.migrate()
+            await db.write_many("insert into room_data(roomid, key, value) values (?, 'room_mode', ?);",
+                                (("!config:lol", RoomMode.CONFIG), ("!room:lol", RoomMode.INTERACTION)))
+            await db.write_many("insert into room_plugins(roomid, pluginname) values (?, ?);",
+                                (("!room:lol", "github"), ("!room:lol", "gitlab")))
+            await db.write("insert into config_room(source_roomid, target_roomid) values (?, ?);",
+                           ("!config:lol", "!room:lol"))
+            await db.write("insert into config_acl(roomid, acl) values (?, ?);", ("!room:lol", "{}"))
+
+            states = await load_room_states(db)
+            assert states == {
+                "!config:lol": RoomState(room_mode=RoomMode.CONFIG, config_targets={"!room:lol"}),
+                "!room:lol": RoomState(room_mode=RoomMode.INTERACTION, plugins=["github", "gitlab"],
+                                       config_sources={"!config:lol"}, acl="{}"),
+            }
+        finally:
+            await db.close()
+
+    asyncio.run(test())
+
+
+def test_room_concurrency():
+    async def test():
+        tracker = RoomTracker(SimpleNamespace(), setup_concurrency=2)
+        running: set[str] = set()
+        done: list[str] = []
+        max_running = 0
+
+        async def setup(room_id: str) -> None:
+            nonlocal max_running
+            running.add(room_id)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.01)
+            running.discard(room_id)
+            if room_id == "!broken:lol":
+                raise RuntimeError("broken room")
+            done.append(room_id)
+
+        room_ids = ["!broken:lol"] + [f"!room{i}:lol" for i in range(5)]
+        await tracker._for_rooms("setup", room_ids, setup)
+        assert max_running == 2
+        assert sorted(done) == room_ids[1:]
+
+    asyncio.run(test())
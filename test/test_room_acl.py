@@ -0,0 +1,122 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from cyberbot.database import Database
+from cyberbot.db_backend import MemoryBackend
+from cyberbot.room_acl import ConfigIndex, Role, RoomACL
+
+
+def run_acl(test):
+    async def runner():
+        db = Database(MemoryBackend())
+        try:
+            await db.migrate()
+            bot = SimpleNamespace(db=db, is_admin=lambda user_id: user_id == "@admin:lol",
+                                  rooms=SimpleNamespace(config_index=ConfigIndex()))
+            await test(db, RoomACL(bot, "!room:lol"))
+        finally:
+            await db.close()
+
+    asyncio.run(runner())
+
+
+def test_acl_cache():
+    async def test(db: Database, room_acl: RoomACL):
+        async with room_acl as acl:
+            assert not acl.user_has_role(Role.config, user_id="@user:lol", user_level=100)
+            assert acl.user_has_role(Role.config, user_id="@admin:lol")
+            acl.user_role_add("@user:lol", Role.config)
+            acl.level_roles_clear(0)
+
+        # changes are undone on exceptions
+        with pytest.raises(RuntimeError):
+            async with room_acl as acl:
+                acl.user_roles_clear("@user:lol")
+                raise RuntimeError("abort")
+
+        # no database access once loaded
+        await db._run(db._connection.execute, "delete from config_acl;")
+        async with room_acl as acl:
+            assert acl.user_has_role(Role.config, user_id="@user:lol")
+            assert not acl.user_has_role(Role.config, user_id="@other:lol", user_level=100)
+
+    run_acl(test)
+
+
+def test_acl_concurrent():
+    async def test(db: Database, room_acl: RoomACL):
+        async def grant(user_id: str) -> None:
+            async with room_acl as acl:
+                acl.user_role_add(user_id, Role.config)
+                # e.g. sending a notice
+                await asyncio.sleep(0.001)
+
+        await asyncio.gather(grant("@a:lol"), grant("@b:lol"))
+
+        async with room_acl as acl:
+            assert acl.user_has_role(Role.config, user_id="@a:lol")
+            assert acl.user_has_role(Role.config, user_id="@b:lol")
+
+        room_acl._cached = None
+        async with room_acl as acl:
+            assert acl.user_has_role(Role.config, user_id="@a:lol")
+            assert acl.user_has_role(Role.config, user_id="@b:lol")
+
+    run_acl(test)
+
+
+def test_acl_levels():
+    async def test(db: Database, room_acl: RoomACL):
+        async with room_acl as acl:
+            acl.level_role_add(50, Role.config)
+            acl.level_role_add(100, Role.config)
+
+        async with room_acl as acl:
+            assert not acl.user_has_role(Role.config, user_level=49)
+            assert acl.user_has_role(Role.config, user_level=50)
+            assert acl.user_has_role(Role.config, user_level=100)
+            acl.level_role_remove(50, Role.config)
+
+        async with room_acl as acl:
+            assert not acl.user_has_role(Role.config, user_level=50)
+            assert acl.user_has_role(Role.config, user_level=100)
+
+        assert await db.read_one("select count(*) from config_acl;") == (1,)
+
+    run_acl(test)
+
+
+def test_config_index():
+    async def test(db: Database, room_acl: RoomACL):
+        index: ConfigIndex = room_acl._bot.rooms.config_index
+        other_acl = RoomACL(room_acl._bot, "!other:lol")
+
+        async with room_acl as acl:
+            acl.user_role_add("@user:lol", Role.config)
+            acl.level_role_add(50, Role.config)
+        async with other_acl as acl:
+            acl.level_role_add(100, Role.config)
+
+        assert index.rooms("@user:lol") == {"!room:lol"}
+        assert index.rooms("@other:lol", 49) == set()
+        assert index.rooms("@other:lol", 50) == {"!room:lol"}
+        assert index.rooms("@other:lol", 100) == {"!room:lol", "!other:lol"}
+
+        # only updated once the transaction is committed
+        async with db.transaction():
+            async with room_acl as acl:
+                acl.user_roles_clear("@user:lol")
+                acl.level_roles_clear(50)
+            assert index.rooms("@user:lol", 50) == {"!room:lol"}
+        assert index.rooms("@user:lol", 50) == set()
+
+        # filled from the stored acls
+        index.remove("!other:lol")
+        assert index.rooms(level=100) == set()
+        async with RoomACL(room_acl._bot, "!other:lol"):
+            pass
+        assert index.rooms(level=100) == {"!other:lol"}
+
+    run_acl(test)
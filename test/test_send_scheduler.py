@@ -0,0 +1,148 @@
+import asyncio
+import itertools
+
+import nio
+import pytest
+
+from cyberbot import send_scheduler
+from cyberbot.send_scheduler import SendError, SendScheduler
+
+
+class FakeServer:
+    def __init__(self):
+        self.sent: list[tuple[str, str]] = []
+        self.contents: list[dict] = []
+        # body -> tx_id of each attempt
+        self.tx_ids: dict[str, list[str]] = dict()
+        # responses to give before accepting a message
+        self.errors: dict[str, list[nio.RoomSendError]] = dict()
+        self._event_ids = itertools.count()
+
+    async def room_send(self, room_id, message_type, content, tx_id, ignore_unverified_devices):
+        # let other sends interleave
+        await asyncio.sleep(0.001)
+        self.tx_ids.setdefault(content["body"], []).append(tx_id)
+        if content["body"] == "crash":
+            raise ValueError("crash")
+        if errors := self.errors.get(content["body"]):
+            return errors.pop(0)
+        self.sent.append((room_id, content["body"]))
+        self.contents.append(content)
+        return nio.RoomSendResponse(f"${next(self._event_ids)}", room_id)
+
+
+def test_send_order(monkeypatch):
+    monkeypatch.setattr(send_scheduler, "_RETRY_DELAY", 0.001)
+
+    async def test():
+        server = FakeServer()
+        scheduler = SendScheduler(server.room_send, rate=1000, burst=10, retries=2)
+
+        server.errors["a1"] = [nio.RoomSendError("slow down", "M_LIMIT_EXCEEDED", 10),
+                               nio.RoomSendError("oops", "M_UNKNOWN")]
+        server.errors["b1"] = [nio.RoomSendError("nope", "M_FORBIDDEN")]
+
+        futures = [scheduler.send(room_id, {"body": f"{room_id}{i}"})
+                   for i in range(3) for room_id in ("a", "b")]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+
+        # ordered per room, despite the retries of a1
+        assert [body for room_id, body in server.sent if room_id == "a"] == ["a0", "a1", "a2"]
+        assert [body for room_id, body in server.sent if room_id == "b"] == ["b0", "b2"]
+        assert isinstance(results[3], SendError)
+        assert all(result.startswith("$") for i, result in enumerate(results) if i != 3)
+        assert scheduler.pending() == 0
+        # retries reuse the transaction id
+        assert len(server.tx_ids["a1"]) == 3
+        assert len(set(server.tx_ids["a1"])) == 1
+        assert server.tx_ids["a0"] != server.tx_ids["a1"]
+
+        # unexpected errors only fail their message
+        results = await asyncio.gather(scheduler.send("a", {"body": "crash"}),
+                                       scheduler.send("a", {"body": "a3"}),
+                                       return_exceptions=True)
+        assert isinstance(results[0], SendError)
+        assert results[1].startswith("$")
+        assert scheduler.pending() == 0
+
+        # too many failures
+        server.errors["c0"] = [nio.RoomSendError("oops", "M_UNKNOWN")] * 3
+        with pytest.raises(SendError):
+            await scheduler.send("c", {"body": "c0"})
+
+        await scheduler.close()
+
+    asyncio.run(test())
+
+
+def test_send_rate():
+    async def test():
+        server = FakeServer()
+        scheduler = SendScheduler(server.room_send, rate=100, burst=2)
+
+        start = asyncio.get_running_loop().time()
+        await asyncio.gather(*(scheduler.send(f"room{i}", {"body": str(i)}) for i in range(6)))
+        # 2 at once, then 4 more at 100/s
+        assert asyncio.get_running_loop().time() - start >= 0.035
+
+        await scheduler.close()
+
+    asyncio.run(test())
+
+
+def test_send_coalesce():
+    async def test():
+        server = FakeServer()
+        scheduler = SendScheduler(server.room_send, coalesce_window=0.01, coalesce_bytes=100)
+
+        def notice(body: str, html: str | None = None) -> dict:
+            content = {"msgtype": "m.notice", "body": body}
+            if html is not None:
+                content.update({"format": "org.matrix.custom.html", "formatted_body": html})
+            return content
+
+        futures = [
+            scheduler.send("a", notice("a<0>"), coalesce=True),
+            scheduler.send("a", notice("a1", "<b>a1</b>"), coalesce=True),
+            # not merged, but sent after the notices
+            scheduler.send("a", {"msgtype": "m.text", "body": "a2"}, coalesce=True),
+            # beyond the size limit
+            scheduler.send("a", notice("a3" * 30), coalesce=True),
+            scheduler.send("a", notice("a4" * 30), coalesce=True),
+            scheduler.send("b", notice("b0"), coalesce=True),
+        ]
+        event_ids = await asyncio.gather(*futures)
+
+        assert event_ids[0] == event_ids[1]
+        assert len(set(event_ids)) == 5
+        assert [body for room_id, body in server.sent if room_id == "a"] == [
+            "a<0>\na1", "a2", "a3" * 30, "a4" * 30,
+        ]
+        assert server.contents[0]["formatted_body"] == "a&lt;0&gt;<br/><b>a1</b>"
+
+        await scheduler.close()
+
+    asyncio.run(test())
+
+
+def test_send_coalesce_cancel():
+    async def test():
+        server = FakeServer()
+        scheduler = SendScheduler(server.room_send, coalesce_window=0.01)
+
+        first = scheduler.send("a", {"msgtype": "m.notice", "body": "a0"}, coalesce=True)
+        second = scheduler.send("a", {"msgtype": "m.notice", "body": "a1"}, coalesce=True)
+        first.cancel()
+
+        # the other sender still waits, so the merged message is sent
+        assert (await second).startswith("$")
+        assert server.sent == [("a", "a0\na1")]
+
+        # nobody waits anymore
+        scheduler.send("a", {"msgtype": "m.notice", "body": "a2"}, coalesce=True).cancel()
+        await scheduler.send("a", {"body": "a3"})
+        assert server.sent[1:] == [("a", "a3")]
+
+        await scheduler.close()
+
+    asyncio.run(test())